@@ -1,8 +1,17 @@
 import os
+import sys
+import stat
 import time
 import string
 import GDCopy.GDService as GDService
+import GDCopy.GDState as GDState
 import json
+import threading
+import weakref
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import numpy as np
 
 # convert time t which is seconds since the epoch to a string parsable by excel
 def time_to_Ymd_HMS(t):
@@ -34,10 +43,12 @@ from ctypes import wintypes
 FILE_ATTRIBUTE_NORMAL = 0x80
 FILE_ATTRIBUTE_RECALL_ON_DATA_ACCESS = 0x00400000  # Placeholder value, check for actual value in your environment
 
-# Load the Windows DLL
-kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+# Load the Windows DLL, there are no file attributes to read elsewhere
+kernel32 = ctypes.WinDLL('kernel32', use_last_error=True) if os.name == 'nt' else None
 
 def get_file_attributes(path):
+    if not kernel32:
+        return 0
     attrs = kernel32.GetFileAttributesW(wintypes.LPCWSTR(path))
     if attrs == -1:
         return 0
@@ -50,8 +61,11 @@ import time
 # Base class defining the shared interface for CDirEntry and GDriveEntry
 # properties include path, name, size, mtime, type, cloud, localsize, owner, type, modified_by
 
+# Entries use __slots__ instead of a per instance __dict__, which roughly halves the memory of each entry
+# on a multi-million item walk.  __weakref__ lets gd_fileid_to_entry refer to entries without keeping them alive.
 class BaseEntry:
     COMMON_ATTRIBUTES_AND_DEFAULTS =   {'path': '', 'name': '', 'size': 0, 'mtime': 0, 'type': 'F', 'localsize': 0, 'owner': '', 'modified_by': ''}
+    __slots__ = tuple(COMMON_ATTRIBUTES_AND_DEFAULTS) + ('__weakref__',)
     
     def __str__(self):
         return f"{self.path} {self.size} {self.strmtime()}"
@@ -85,34 +99,42 @@ class BaseEntry:
         return []
      
 class AnonDirEntry(BaseEntry):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__('')
  
     
 # Subclass for handling local filesystem entries
 class CDirEntry(BaseEntry):
+    __slots__ = ('cloud',)
+
+    # everything is taken from a single stat() result.  For a DirEntry on Windows that result comes from
+    # the directory listing itself, including st_file_attributes, so no extra system call is made.
     def __init__(self, entry):
         if isinstance(entry, os.DirEntry):
             super().__init__(entry.path)
-            self.size = entry.stat().st_size
-            self.mtime = entry.stat().st_mtime
-            self.type = 'D' if entry.is_dir() else 'F'
+            st = entry.stat()
         elif isinstance(entry, str):
             super().__init__(entry)
-            self.size = os.stat(entry).st_size
-            self.mtime = os.stat(entry).st_mtime
-            self.type = 'D' if os.path.isdir(entry) else 'F'
+            st = os.stat(entry)
         else:
             raise ValueError("Invalid entry type for CDirEntry initialization.{entry}") 
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.type = 'D' if stat.S_ISDIR(st.st_mode) else 'F'
+        attrs = getattr(st, 'st_file_attributes', None)
+        if attrs is None:
+            attrs = get_file_attributes(self.path)
+        # Check for specific cloud-related attribute
+        self.cloud = (attrs & FILE_ATTRIBUTE_RECALL_ON_DATA_ACCESS) == FILE_ATTRIBUTE_RECALL_ON_DATA_ACCESS
         if self.is_cloud():
             self.localsize = 0
         else:
             self.localsize = self.size
 
     def is_cloud(self):
-        attrs = get_file_attributes(self.path)
-        # Check for specific cloud-related attribute
-        return (attrs & FILE_ATTRIBUTE_RECALL_ON_DATA_ACCESS) == FILE_ATTRIBUTE_RECALL_ON_DATA_ACCESS
+        return self.cloud
 
     def _get_owner(self):
         # Platform-specific implementation for file ownership
@@ -132,10 +154,79 @@ class CDirEntry(BaseEntry):
 
     def listfolder(self):
         """List folder contents for local directory"""
-        return [CDirEntry(entry) for entry in os.scandir(self.path)]
-
-drive_service = None
-gd_fileid_to_entry = {}
+        with os.scandir(self.path) as entries:
+            return [CDirEntry(entry) for entry in entries]
+
+service_pool = GDService.ServicePool()   # drive services, one per thread; replace to walk a FakeDrive
+gd_fileid_to_entry = weakref.WeakValueDictionary()   # google folder id -> GDEntry, for folders still in use
+
+_interned_lists = {}
+
+def intern_list(values):
+    """Return a shared tuple equal to values.  Most entries carry one of a handful of permission lists,
+    so they all refer to one copy instead of each holding their own list."""
+    key = tuple(values)
+    return _interned_lists.setdefault(key, key)
+
+@functools.lru_cache(maxsize=None)
+def _local_hour(year, month, day, hour):
+    """mktime() of the start of the hour, or None when the hour is not 3600 seconds long, as in an hour that a
+    daylight saving change, which is only 30 minutes in some zones, falls inside."""
+    start = time.mktime((year, month, day, hour, 0, 0, 0, 0, -1))
+    if time.mktime((year, month, day, hour + 1, 0, 0, 0, 0, -1)) - start != 3600:
+        return None
+    return start
+
+def drive_time(value):
+    """Seconds since the epoch of a Drive timestamp such as '2024-05-05T13:45:10.123Z', read as local time.
+    Equal to time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")), which this replaces, but several
+    times faster: the fields are sliced out directly and mktime() is called once per distinct hour, every
+    minute of an hour with a constant local offset being that many minutes after its start.  Minutes of
+    the few hours a daylight saving change falls in are converted with mktime() on their own."""
+    if len(value) >= 19 and value[10] == 'T':
+        try:
+            year, month, day, hour, minute, second = (int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                                      int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        except ValueError:
+            pass
+        else:
+            start = _local_hour(year, month, day, hour)
+            if start is not None:
+                return start + minute * 60 + second
+            return time.mktime((year, month, day, hour, minute, second, 0, 0, -1))
+    return time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ"))
+
+_user_labels = {}
+
+def user_label(user):
+    """'name (email)' for a user dict from the API such as lastModifyingUser, formatted once per user."""
+    if not user:
+        return ''
+    key = (user.get('displayName', 'Unknown'), user.get('emailAddress', 'Unknown'))
+    label = _user_labels.get(key)
+    if label is None:
+        label = _user_labels[key] = sys.intern(key[0] + ' (' + key[1] + ')')
+    return label
+
+_listing_permission_strings = {}
+
+def listing_permission_string(permission):
+    """str(CPermission) of a permission from a files().list() item, worked out once per distinct grant."""
+    if 'permissionDetails' in permission:
+        return sys.intern(str(GDService.CPermission.from_dict(permission)))
+    key = (permission.get('role'), permission.get('type'), permission.get('emailAddress'), permission.get('domain'))
+    string = _listing_permission_strings.get(key)
+    if string is None:
+        string = _listing_permission_strings[key] = sys.intern(str(GDService.CPermission.from_dict(permission)))
+    return string
+
+def get_drive_service():
+    """Return the drive service for the calling thread, so the worker threads of a concurrent walk never
+    share a connection."""
+    return service_pool.service()
+
+# the storage behind GDEntry's lazy mtime property
+_mtime_slot = BaseEntry.mtime
 
 # Subclass for handling Google Drive entries
 # properties include path, name, size, mtime, cloud, localsize, owner, type, modified_by
@@ -145,14 +236,18 @@ class GDEntry(BaseEntry):
     # or a GDEntry instance
     # or a string which represents the URL or ID of the entry
     # parent is the parent folder which is derived from BaseEntry
+    __slots__ = ('parent', 'defer_permissions', 'tree', 'cache', 'root', 'id', 'drive_id', 'link',
+                 'permissions', 'direct_permissions', 'cpermissions', 'fields')
     
-    def __init__(self, entry, parent: BaseEntry=None):
-        # Initialize the drive service if not already initialized
-        global drive_service
-        if not drive_service:
-            drive_service = GDService.authenticate()[0]
-
+    # defer_permissions leaves permissions set to None for shared drive items, so a caller listing many
+    # entries can resolve them together with permission_resolver.resolve()
+    def __init__(self, entry, parent: BaseEntry=None, defer_permissions=False):
         self.parent = parent
+        self.defer_permissions = defer_permissions
+        # children map (parent id -> list of drive items) from a bulk drive listing, shared down the tree
+        self.tree = getattr(parent, 'tree', None)
+        # GDService.MetadataCache used for folder listings, shared down the tree
+        self.cache = getattr(parent, 'cache', None)
 
         # Initialize from another GDriveEntry instance
         if isinstance(entry, GDEntry):    
@@ -161,12 +256,12 @@ class GDEntry(BaseEntry):
             self.fields = entry.fields
             raise ValueError("Invalid entry type for GDriveEntry initialization. GDEntry")
         elif isinstance(entry, dict):
-            super().__init__(entry) # copy the attributes from the entry
+            # every attribute is set from the API response, so BaseEntry's defaults are not needed
             self._initialize_from_drivedata(entry)
         elif isinstance(entry, str):
             super().__init__(entry) # copy the attributes from the entry
             # Initialize from URL, drive ID, or folder ID
-            drivedata = GDService.get_metadata(drive_service, entry)
+            drivedata = GDService.get_metadata(get_drive_service(), entry)
             self._initialize_from_drivedata(drivedata)
             self.path = self.name
         else:
@@ -179,41 +274,47 @@ class GDEntry(BaseEntry):
 
     def _initialize_from_drivedata(self, drivedata):
         """Initialize entry details from Google Drive API based on a URL or ID."""
-        self.root = drivedata
+        self.root = drivedata   # raw API response, released by permission_resolver once permissions are resolved
         self.id = drivedata.get("id")
-        gd_fileid_to_entry[self.id] = self  # map google File ID back to a GDEntry
+        self.drive_id = drivedata.get("driveId")
+        self.type = 'D' if drivedata.get('mimeType') == 'application/vnd.google-apps.folder' else 'F'
+        if self.type == 'D':
+            gd_fileid_to_entry[self.id] = self  # map google folder ID back to a GDEntry
 
         self.name = drivedata.get("name").replace('/', '_')
         # get the size as an integer
         self.size = int(drivedata.get('size', 0))
+        self.localsize = 0
 
-        modified_time= drivedata.get('modifiedTime')
-        self.mtime = time.mktime(time.strptime(modified_time, "%Y-%m-%dT%H:%M:%S.%fZ"))
-
-        # get the last modifying user and owner
-        lmu = drivedata.get('lastModifyingUser', {})
-        if lmu:
-            self.modified_by = lmu.get('displayName', 'Unknown') + ' (' + lmu.get('emailAddress', 'Unknown') + ')'
-        else:
-            self.modified_by = ''
-        owner = drivedata.get('owners', [{}])[0]
-        if owner:
-            self.owner = owner.get('displayName', 'Unknown') + ' (' + owner.get('emailAddress', 'Unknown') + ')'
-        else:
-            self.owner = ''
-
-        self.owner = drivedata.get('owners', [{}])[0].get('displayName', 'Unknown')
-        self.type = 'D' if drivedata.get('mimeType') == 'application/vnd.google-apps.folder' else 'F'
+        # mtime holds the modifiedTime string until it is first read
+        self.mtime = drivedata.get('modifiedTime')
+        self.modified_by = user_label(drivedata.get('lastModifyingUser'))
+        self.owner = sys.intern(drivedata.get('owners', [{}])[0].get('displayName', 'Unknown'))
 
         self.link = drivedata.get('webViewLink')
 
         # get the permissions for the file
-        if self.root.get('driveId'):
-            self.load_permissions_from_service()
-        else:
-            self.load_permissions_from_file()        
+        self.permissions = None
+        self.direct_permissions = None
+        self.cpermissions = None
+        if not self.defer_permissions:
+            permission_resolver.resolve([self])
         return
     
+    # mtime is worked out the first time it is read, as many entries are only counted.  Until then the
+    # BaseEntry slot holds the modifiedTime string from the API response.
+    @property
+    def mtime(self):
+        mtime = _mtime_slot.__get__(self)
+        if mtime.__class__ is str:
+            mtime = drive_time(mtime)
+            _mtime_slot.__set__(self, mtime)
+        return mtime
+
+    @mtime.setter
+    def mtime(self, value):
+        _mtime_slot.__set__(self, value)
+
     # load the file().list() permissions into self.permissions
     # then calculate direct_permissions by comparing self.permissions with parent.permissions
     def load_permissions_from_file(self):
@@ -227,21 +328,46 @@ class GDEntry(BaseEntry):
         else:
             pperm = []
 
-        self.permissions = ["f:"]
+        permissions = ["f:"]
         for p in perm:
-            self.permissions.append(str(GDService.CPermission.from_dict(p)))
+            permissions.append(listing_permission_string(p))
 
-        self.direct_permissions = ["f:"]
-        for p in self.permissions:
+        direct_permissions = ["f:"]
+        for p in permissions:
             if p not in pperm:
-                self.direct_permissions.append(p)
+                direct_permissions.append(p)
+        self.permissions = intern_list(permissions)
+        self.direct_permissions = intern_list(direct_permissions)
         return
 
-    def load_permissions_from_service(self):
+    # permissions is the permissions().list() result for this entry when it has already been fetched,
+    # otherwise it is fetched here
+    def load_permissions_from_service(self, permissions=None):
+        if permissions is None:
+            cpermissions = GDService.CPermission.from_service(get_drive_service(), self.id)
+        else:
+            cpermissions = [GDService.CPermission.from_dict(p) for p in permissions]
+        self._set_service_permissions(cpermissions)
+
+    def inherit_permissions(self):
+        """Set the permissions to those of the parent folder, all inherited.  This is what the service
+        returns for a shared drive item that has no permissions of its own.  They are the same for every
+        such child, so they are worked out once per parent folder."""
+        inherited = permission_resolver.inherited.get(self.parent.id)
+        if inherited is None:
+            cpermissions = [p.inherited_copy(self.parent.id) for p in self.parent.cpermissions]
+            self._set_service_permissions(cpermissions)
+            inherited = permission_resolver.inherited[self.parent.id] = (self.permissions, self.direct_permissions, cpermissions)
+        self.permissions, self.direct_permissions, cpermissions = inherited
+        self.cpermissions = cpermissions if self.is_dir() else None
+
+    def _set_service_permissions(self, cpermissions):
+        # folders keep their CPermission list so their children's permissions can be inferred from it
+        self.cpermissions = cpermissions if self.is_dir() else None
         perms = ["s:"]
         dperms = ["s:"]
-        for p in GDService.CPermission.from_service(drive_service, self.id):
-            thisperm = str(p)
+        for p in cpermissions:
+            thisperm = sys.intern(str(p))
             perms.append(thisperm)
             # look at each of the permission details in the current permission, and if any of them are 
             # not in the parent permissions, then add the current permission to direct_permissions
@@ -250,62 +376,205 @@ class GDEntry(BaseEntry):
                 if not pd.inherited:
                     dperms.append(thisperm)
                     break
-        self.permissions = perms
-        self.direct_permissions = dperms
+        self.permissions = intern_list(perms)
+        self.direct_permissions = intern_list(dperms)
         return
-            
+
+
+    def load_tree(self):
+        """Fetch the whole shared drive containing this entry as one flat listing, so listfolder() of this
+        entry and everything below it is served from memory instead of one list_files() query per folder.
+        Returns False, leaving per folder listing in place, when the entry is not on a shared drive."""
+        if not self.drive_id:
+            return False
+        items = GDService.list_drive_files(get_drive_service(), self.drive_id, profile='du-report')
+        self.tree = GDService.build_children_map(items)
+        return True
+
     def listfolder(self):
         """List folder contents for Google Drive folder."""
-        children = GDService.list_files(drive_service, self.id, additional_fields="lastModifyingUser, permissions(id, role, type, emailAddress, domain), webViewLink")  # Assume GoogleDriveService provides list_folder method
+        if self.tree is not None:
+            # each folder is listed once, so hand the children over and drop them from the map
+            children = self.tree.pop(self.id, [])
+        elif self.cache:
+            children = self.cache.list_files(get_drive_service(), self.id, profile='du-report')
+        else:
+            # entries are built from each page as it arrives while service_pool fetches the next
+            children = GDService.iter_files(get_drive_service(), self.id, profile='du-report', pool=service_pool)
         fchildren = []
         for child in children:
-            dentry = GDEntry(child, parent=self)
+            dentry = GDEntry(child, parent=self, defer_permissions=True)
             fchildren.append(dentry)
+        permission_resolver.resolve(fchildren)
         return fchildren
     
+class PermissionResolver:
+    """
+    Resolves the permissions and direct_permissions of GDEntry items, calling the Drive API only when
+    they cannot be worked out from data already in hand.
+
+    - My Drive items use the permissions included in their listing (GDEntry.load_permissions_from_file).
+    - Shared drive items whose listing says hasAugmentedPermissions is false, and whose inherited
+      permissions are not disabled, carry exactly their parent folder's permissions, all inherited,
+      so they are derived from the parent (GDEntry.inherit_permissions).
+    - The remaining shared drive items are fetched with batched permissions().list() calls.
+
+    The counters report how many permissions().list() calls were made and how many were avoided.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.fetched = 0
+        self.inferred = 0
+        self.from_listing = 0
+        self.inherited = {}  # parent folder id -> (permissions, direct_permissions, cpermissions) of a child inheriting them all
+
+    def can_infer(self, entry):
+        return (entry.parent is not None
+                and getattr(entry.parent, 'cpermissions', None) is not None
+                and entry.root.get('hasAugmentedPermissions') is False
+                and not entry.root.get('inheritedPermissionsDisabled'))
+
+    def resolve(self, entries):
+        fetch = []
+        inferred = from_listing = 0
+        for entry in entries:
+            if entry.permissions is not None:
+                continue
+            if not entry.drive_id:
+                entry.load_permissions_from_file()
+                from_listing += 1
+            elif self.can_infer(entry):
+                entry.inherit_permissions()
+                inferred += 1
+            else:
+                fetch.append(entry)
+        if len(fetch) == 1:
+            fetch[0].load_permissions_from_service()
+        elif fetch:
+            details = GDService.get_permission_details_batch(get_drive_service(), [entry.id for entry in fetch])
+            for entry in fetch:
+                entry.load_permissions_from_service(details.get(entry.id, []))
+        for entry in entries:
+            entry.root = None   # everything needed from the API response has been extracted
+        with self.lock:
+            self.fetched += len(fetch)
+            self.inferred += inferred
+            self.from_listing += from_listing
+
+    def report(self):
+        return (f"Permissions: {self.fetched} fetched from Drive, {self.inferred} inferred from the parent folder, "
+                f"{self.from_listing} from listings - {self.inferred + self.from_listing} permissions().list calls avoided")
+
+permission_resolver = PermissionResolver()
+
 progress = TimedProgress()
 
 class Permissions:
     def __init__(self, permissions):
         self.permissions = permissions
-src2dest = {}
-dest2src = {}
+original_paths = None  # destination id -> path of the migration source, built on first use
 
 def get_original_path(file_id):
-    # Ensure the state is loaded
-    global dest2src, src2dest
-
-    if not src2dest:
-        with open('gdcopy_state.json', 'r') as f:
-            state = json.load(f)
-            src2dest = state.get('src2dest', {})
-
-            # src2dest[id]['dest_id'] = dest_id, so invert this creating a dest2src dictionary
-            dest2src = {}
-            for src_id, file in src2dest.items():
-                dest_id = file.get('dest_id')
-                if dest_id:
-                    dest2src[dest_id] = file
-
-    # calculate the path for the original file
-    # if the file_id is in dest2src, then the original path is the path of the src2dest entry, co 
-    if file_id in dest2src:
-        file_id = dest2src[file_id]['id']  # get the original file_id
-        # walk the parents chain of src2dest[file_id] to calculate the path, only looking at the first element of parents.
-        path = []
-        while file_id and file_id in src2dest:
-            path.append(src2dest[file_id]['name'])
-            # get the parent of the current file_id if they are defined and there is a first element.
-            if 'parents' in src2dest[file_id] and src2dest[file_id]['parents']:
-                file_id = src2dest[file_id]['parents'][0]
-            else:
-                file_id = None
-        path.reverse()
-        return '/'.join(path)
+    """Return the path in the migration source of the item copied to file_id, or None if it was not copied by gdcopy."""
+    global original_paths
+    if original_paths is None:
+        # the first run converts gdcopy_state.json into the indexed gdcopy_state.db
+        if os.path.exists('gdcopy_state.db') or os.path.exists('gdcopy_state.json'):
+            store = GDState.open_state()
+            original_paths = GDState.original_paths(store)
+            store.close()
+        else:
+            original_paths = {}
+    return original_paths.get(file_id)
 
-    # If not found, return None
-    return None
 
+class WalkCheckpoint:
+    """
+    Append-only JSON lines log that lets an interrupted FileSystemWalker resume without redoing finished folders.
+
+    Every row the collector accepts is logged as {"row": ...}.  When a folder and everything beneath it
+    has been walked, a {"done": key, ...} record stores its rollups (size, localsize, filecount and the
+    most recent entry) together with the byte range of the log that holds its rows.  A restarted walk that
+    reaches a finished folder replays the rows in that range into the collector and takes the stored
+    rollups instead of listing the folder again.  The replay is logged as a {"replay": [start, end]}
+    reference rather than by writing the rows again, so that the range of the enclosing folder covers them
+    and the log does not grow on every resume.  Rows logged for folders that never finished are ignored.
+
+    Rows are read back from the file when replayed and are not kept in memory.  Records are flushed as each
+    folder finishes and synced to disk at most every sync_interval seconds.  The log is left in place when
+    the walk ends, see FileSystemWalker.remove_checkpoint().
+    """
+    def __init__(self, path, sync_interval=30):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.last_sync = time.time()
+        self.done = {}      # folder key -> done record
+        if os.path.exists(path):
+            self._load()
+        self.file = open(path, 'ab')
+        self.offset = self.file.tell()
+
+    def _load(self):
+        with open(self.path, 'r+b') as f:
+            content = f.read()
+            # drop a record cut short by a crash
+            end = content.rfind(b'\n') + 1
+            if end < len(content):
+                f.truncate(end)
+        for line in content[:end].splitlines():
+            if line.startswith(b'{"done"'):
+                record = json.loads(line)
+                self.done[record['done']] = record
+        print(f"Resuming from {self.path}: {len(self.done)} folders already walked")
+
+    @staticmethod
+    def key(entry):
+        return getattr(entry, 'id', None) or entry.path
+
+    def _write(self, record):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        self.file.write(line)
+        self.offset += len(line)
+
+    def add_row(self, row):
+        self._write({'row': row})
+
+    def completed(self, entry):
+        return self.done.get(self.key(entry))
+
+    def complete(self, entry, mostrecent, size, localsize, filecount, start):
+        """Record that entry and everything beneath it is finished, its rows being those logged since offset start."""
+        snapshot = {key: getattr(mostrecent, key) for key in BaseEntry.COMMON_ATTRIBUTES_AND_DEFAULTS}
+        record = {'done': self.key(entry), 'mostrecent': snapshot, 'size': size, 'localsize': localsize,
+                  'filecount': filecount, 'start': start, 'end': self.offset}
+        self.done[record['done']] = record
+        self._write(record)
+        self.file.flush()
+        if time.time() - self.last_sync > self.sync_interval:
+            os.fsync(self.file.fileno())
+            self.last_sync = time.time()
+
+    def rows(self, start, end):
+        """Yield the rows logged between offsets start and end, following replay references."""
+        self.file.flush()
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while f.tell() < end:
+                record = json.loads(f.readline())
+                if 'row' in record:
+                    yield record['row']
+                elif 'replay' in record:
+                    yield from self.rows(*record['replay'])
+
+    def replayed(self, done):
+        """Log that the rows of the finished folder done were replayed, as part of the folder being walked."""
+        self._write({'replay': [done['start'], done['end']]})
+
+    def close(self):
+        self.file.close()
 
 # FileSystemWalker walks the hierarchy of the file system under the path.
 class FileSystemWalker:
@@ -316,23 +585,105 @@ class FileSystemWalker:
     The class has a method walk() that traverses the hierarchy and calls collector.add() for each entry.
     The class has a method get_file_names(directory_path) that returns a list of file names in the specified directory.
     The class has a method get_directory_contents(directory_path) that returns a tuple of (root, dirs, files) for the specified directory.
+
+    When max_inflight is set, folder listings are fetched by a pool of max_inflight worker threads:  as soon
+    as a folder is listed, its sub folders are queued for listing ahead of the rest, and the walk consumes
+    them in the same depth first order as the serial walk.  At most readahead (4 * max_inflight) listings
+    are fetched or held ahead of the walk, so the pool cannot run ahead and hold most of a large tree in memory.  The rollups and the collector.add() rows are identical
+    to the serial walk, and collector.add() is only ever called from the calling thread.  max_inflight caps
+    the number of concurrent listfolder() calls, which keeps a Drive walk under the API quota.
+
+    When bulk is set and path is on a shared drive, the whole drive is pulled as one flat listing
+    (GDEntry.load_tree) and the walk runs over the in memory tree, with the same rollup logic.
+
+    When cache_file is set, Drive folder listings go through a GDService.MetadataCache stored in that
+    file, so a repeat walk only fetches what changed since the previous one.
+
+    When checkpoint_file is set, finished folders are recorded in a WalkCheckpoint so that a walk that
+    crashes, or loses its token, part way through resumes where it stopped when it is run again.  The
+    checkpoint outlives walk(), so that a crash while saving the output, or while walking the next path
+    of the same report, does not lose it; call remove_checkpoint() once the output has been saved.
     """
-    def __init__(self, path, collector):
+    def __init__(self, path, collector, max_inflight=None, bulk=False, cache_file=None, checkpoint_file=None):
         self.collector = collector
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint = None
+        self.max_inflight = max_inflight
+        self.readahead = 4 * (max_inflight or 0)
+        self.pool = None
+        self.pending = {}   # folder entry -> Future for its prefetched listfolder()
+        self.queue = deque()  # folders to prefetch, in the order the walk will reach them
         # if path starts with a drive letter and : then assume it is a local file system path and usecreate entry with CDirEntry, otherwise GDWalker
         # for a local file system path, create entry with CDirEntry, otherwise GDEntry
-        if len(path) > 2 and path[1] == ':':
+        if (len(path) > 2 and path[1] == ':') or path.startswith('/'):
             self.root = CDirEntry(path)
         else:
+            permission_resolver.reset()
             self.root = GDEntry(path)
+            if cache_file:
+                self.root.cache = GDService.MetadataCache(cache_file)
+            if bulk and not self.root.load_tree():
+                print(f"{path} is not on a shared drive, listing folder by folder")
     
     def walk(self):
-     
-        srecent, ssize, slocalsize, scount = self._walk(self.root)
+        if self.checkpoint_file:
+            self.checkpoint = WalkCheckpoint(self.checkpoint_file)
+        if self.max_inflight:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_inflight)
+        try:
+            srecent, ssize, slocalsize, scount = self._walk(self.root)
+        finally:
+            if self.pool:
+                self.pool.shutdown(wait=True, cancel_futures=True)
+                self.pool = None
+                self.pending = {}
+                self.queue.clear()
+            if self.checkpoint:
+                self.checkpoint.close()
+        if isinstance(self.root, GDEntry):
+            print(permission_resolver.report())
+            print(GDService.rate_limiter.report())
+        cache = getattr(self.root, 'cache', None)
+        if cache:
+            print(f"Metadata cache: {cache.hits} folder listings from cache, {cache.misses} from Drive, {cache.changes_applied} changes applied")
         self.root.size = ssize
         self.root.localsize = slocalsize
         self.collector.add(self.root, mostrecent=srecent, filecount=scount)
 
+    def remove_checkpoint(self):
+        """Remove the checkpoint of a finished walk, once its output has been saved."""
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def _add(self, entry, **kwargs):
+        """collector.add(), logging the row when checkpointing."""
+        row = self.collector.add(entry, **kwargs)
+        if self.checkpoint and row:
+            self.checkpoint.add_row(row)
+
+    def _replay(self, done):
+        """Re-add the rows of a folder finished by an earlier run and return its stored rollups."""
+        for row in self.checkpoint.rows(done['start'], done['end']):
+            self.collector.add_row(row)
+        self.checkpoint.replayed(done)
+        return BaseEntry(done['mostrecent']), done['size'], done['localsize'], done['filecount']
+
+    def _listfolder(self, folder):
+        """Return the children of folder, taking the prefetched listing when walking concurrently."""
+        future = self.pending.pop(folder, None)
+        if future is None and self.queue and self.queue[0] is folder:
+            self.queue.popleft()    # reached before its prefetch was submitted
+        children = future.result() if future else folder.listfolder()
+        if self.pool:
+            # the sub folders are walked next, so they go ahead of the folders queued earlier
+            self.queue.extendleft(reversed([child for child in children
+                                            if child.is_dir() and child.name != 'desktop.ini'
+                                            and not (self.checkpoint and self.checkpoint.completed(child))]))
+            while self.queue and len(self.pending) < self.readahead:
+                child = self.queue.popleft()
+                self.pending[child] = self.pool.submit(child.listfolder)
+        return children
+
     def _walk(self, folder):
         entry = None
         try:
@@ -341,15 +692,23 @@ class FileSystemWalker:
             totlocalsize = 0
             filecount = 0
             entry = None
-            for entry in folder.listfolder():
+            for entry in self._listfolder(folder):
                 if entry.name == 'desktop.ini':
                     continue
                 if entry.is_dir():
-                    # get values from sub folder
-                    srecent, ssize, slocalsize, scount = self._walk(entry)
-                    entry.size = ssize          # size for a folder is the sum of the sizes of its contents
-                    entry.localsize = slocalsize
-                    self.collector.add(entry, mostrecent=srecent, filecount=scount)
+                    done = self.checkpoint and self.checkpoint.completed(entry)
+                    if done:
+                        # finished by an earlier run
+                        srecent, ssize, slocalsize, scount = self._replay(done)
+                    else:
+                        start = self.checkpoint.offset if self.checkpoint else 0
+                        # get values from sub folder
+                        srecent, ssize, slocalsize, scount = self._walk(entry)
+                        entry.size = ssize          # size for a folder is the sum of the sizes of its contents
+                        entry.localsize = slocalsize
+                        self._add(entry, mostrecent=srecent, filecount=scount)
+                        if self.checkpoint:
+                            self.checkpoint.complete(entry, srecent, ssize, slocalsize, scount, start)
                     totsize += ssize 
                     totlocalsize += slocalsize
                     filecount += scount
@@ -361,19 +720,166 @@ class FileSystemWalker:
                     totsize += entry.size
                     totlocalsize += entry.localsize
                     filecount += 1
-                    self.collector.add(entry)
+                    self._add(entry)
 
         except OSError as e:
             if entry:
                 path = entry.path
             else:
                 path = folder.path
-            self.collector.add(entry, mostrecent=mostrecent, error=str(e), path=path)
+            self._add(entry, mostrecent=mostrecent, error=str(e), path=path)
         return mostrecent, totsize, totlocalsize, filecount
     
+class TreeRollup:
+    """
+    The folder rollups of FileSystemWalker for a whole tree at once, computed with NumPy instead of a
+    Python call per entry.  The tree is a flat table, one row per entry:
+
+        parent     row of the parent folder, -1 for the root
+        size, localsize, mtime, is_dir
+        include    optional, rows that are False add nothing to their parent
+
+    rollup() sets, for every folder row, size, localsize and filecount to the totals of everything below
+    it, and mostrecent to the row of the file below it with the latest mtime, -1 if there is none.  As in
+    the walker, only files with an mtime after the epoch count.  Rows are grouped by depth, and
+    each level, deepest first, is added into its parents with np.add.at and reduced to the most recent
+    per parent with one lexsort, so the cost is a few array passes per level.
+
+    Files sharing the latest mtime go to the lowest row, and the walker picks the first one it meets.  The
+    builders below therefore number rows in walk order, each folder followed by its contents in listing
+    order, which makes the results the same as the walker's, as verify_rollup() checks.
+    """
+    def __init__(self, parent, size, localsize, mtime, is_dir, include=None, paths=None):
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.is_dir = np.asarray(is_dir, dtype=bool)
+        self.own_size = np.asarray(size, dtype=np.int64)
+        self.own_localsize = np.asarray(localsize, dtype=np.int64)
+        self.mtime = np.asarray(mtime, dtype=np.float64)
+        self.include = np.ones(len(self.parent), dtype=bool) if include is None else np.asarray(include, dtype=bool)
+        self.paths = paths
+        self.size = self.localsize = self.filecount = self.mostrecent = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def depths(self):
+        """
+        The depth of every row, the root being 0.  Found by pointer jumping: each pass adds the distance
+        already known from a row's current ancestor and moves on to that ancestor's ancestor, so a tree of
+        depth d takes log2(d) passes.
+        """
+        ancestor = np.where(self.parent >= 0, self.parent, np.arange(len(self)))
+        depth = (self.parent >= 0).astype(np.int64)
+        while True:
+            next_ancestor = ancestor[ancestor]
+            if np.array_equal(next_ancestor, ancestor):
+                return depth
+            depth += depth[ancestor]
+            ancestor = next_ancestor
+
+    def rollup(self):
+        n = len(self)
+        files = ~self.is_dir & self.include
+        self.size = np.where(files, self.own_size, 0)
+        self.localsize = np.where(files, self.own_localsize, 0)
+        self.filecount = files.astype(np.int64)
+        self.mostrecent = np.where(files & (self.mtime > 0), np.arange(n), -1)
+        latest = np.empty(n)
+
+        depth = self.depths()
+        by_depth = np.argsort(depth, kind='stable')
+        starts = np.searchsorted(depth[by_depth], np.arange(depth.max() + 2))
+        for level in range(depth.max(), 0, -1):
+            rows = by_depth[starts[level]:starts[level + 1]]
+            rows = rows[self.include[rows]]
+            parents = self.parent[rows]
+            np.add.at(self.size, parents, self.size[rows])
+            np.add.at(self.localsize, parents, self.localsize[rows])
+            np.add.at(self.filecount, parents, self.filecount[rows])
+
+            # every child of a folder is on the same level, so each folder gets its most recent in one pass:
+            # the latest mtime of its children's, then the lowest row among those with it
+            rows = rows[self.mostrecent[rows] >= 0]
+            best = self.mostrecent[rows]
+            parents = self.parent[rows]
+            latest[parents] = -np.inf
+            np.maximum.at(latest, parents, self.mtime[best])
+            tied = self.mtime[best] == latest[parents]
+            self.mostrecent[parents[tied]] = n
+            np.minimum.at(self.mostrecent, parents[tied], best[tied])
+        return self
+
+def rollup_table_from_items(items, root):
+    """
+    TreeRollup of root, a files().get() item, and everything below it in items, e.g. the output of
+    GDService.list_drive_files(), with rows in walk order and paths as GDEntry builds them.
+    """
+    children = GDService.build_children_map(items)
+    parent, size, mtime, is_dir, paths = [], [], [], [], []
+    stack = [(root, -1, None)]
+    while stack:
+        item, parent_row, parent_path = stack.pop()
+        row = len(parent)
+        name = item['name'].replace('/', '_')
+        path = name if parent_path is None else parent_path + '/' + name
+        parent.append(parent_row)
+        size.append(int(item.get('size', 0)))
+        mtime.append(drive_time(item['modifiedTime']))
+        is_dir.append(item['mimeType'] == 'application/vnd.google-apps.folder')
+        paths.append(path)
+        below = [child for child in children.get(item['id'], []) if child['name'] != 'desktop.ini']
+        stack.extend((child, row, path) for child in reversed(below))
+    return TreeRollup(parent, size, np.zeros(len(parent)), mtime, is_dir, paths=paths)
+
+def rollup_table_from_scan(root):
+    """TreeRollup of the local folder root, scanned in walk order with CDirEntry."""
+    parent, size, localsize, mtime, is_dir, paths = [], [], [], [], [], []
+    stack = [(CDirEntry(root), -1)]
+    while stack:
+        entry, parent_row = stack.pop()
+        row = len(parent)
+        parent.append(parent_row)
+        size.append(entry.size)
+        localsize.append(entry.localsize)
+        mtime.append(entry.mtime)
+        is_dir.append(entry.is_dir())
+        paths.append(entry.path)
+        if entry.is_dir():
+            below = [child for child in entry.listfolder() if child.name != 'desktop.ini']
+            stack.extend((child, row) for child in reversed(below))
+    return TreeRollup(parent, size, localsize, mtime, is_dir, paths=paths)
+
+class RecordingCollector:
+    """Collector stand-in keeping the rollups the walker reports for each folder, keyed by path."""
+    def __init__(self):
+        self.folders = {}
+
+    def add(self, entry, mostrecent=None, path=None, error=None, filecount=None):
+        if entry is not None and entry.is_dir():
+            recent = (mostrecent.path, mostrecent.mtime) if mostrecent is not None and mostrecent.path else None
+            self.folders[entry.path] = (entry.size, entry.localsize, filecount or 0, recent)
+
+def verify_rollup(path, table, **walker_args):
+    """Walk path with FileSystemWalker and return the folders whose rollups differ from table.rollup(), as (path, walker, table)."""
+    collector = RecordingCollector()
+    FileSystemWalker(path, collector, **walker_args).walk()
+    table.rollup()
+    differences = []
+    for row in np.flatnonzero(table.is_dir):
+        best = table.mostrecent[row]
+        recent = (table.paths[best], table.mtime[best]) if best >= 0 else None
+        rolled = (int(table.size[row]), int(table.localsize[row]), int(table.filecount[row]), recent)
+        walked = collector.folders.get(table.paths[row])
+        if walked != rolled:
+            differences.append((table.paths[row], walked, rolled))
+    if len(collector.folders) != int(table.is_dir.sum()):
+        differences.append(('folder count', len(collector.folders), int(table.is_dir.sum())))
+    return differences
+
 
 import csv
-import win32security
+if os.name == 'nt':
+    import win32security
 import pandas as pd
 
 class Collector:
@@ -381,6 +887,9 @@ class Collector:
         self.output_file = output_file
         self.exclude = exclude
         self.data_rows = []
+        self.row_count = 0
+        # stay within the ~1,048,000 row limit of an Excel sheet, parquet and arrow output have no limit
+        self.limit_rows = not output_file.endswith(('.parquet', '.arrow'))
         self.roots = paths
         self.write_headers = ['root', 'path', 'size', 'mtime', 'localsize', 'cloud',
                                 'filecount',
@@ -455,23 +964,84 @@ class Collector:
         # return if an item in self.exclude is contained in path and the filecount is non zero
         if any([ex in adding["path"] for ex in self.exclude]): # and not filecount:
             return
-        # if we have > 1M entries, then only add the ones that have a filecount.
-        if (len(self.data_rows) > 1000000) and not filecount:
-            return
-        if (len(self.data_rows) > 1048000):
-            return
+        return self.add_row(adding)
+
+    def add_row(self, adding):
+        """Accept a finished row, applying the row limits, and hand it to _emit().
+        Returns the row, or None if it was dropped."""
+        if self.limit_rows:
+            # if we have > 1M entries, then only add the ones that have a filecount.
+            if (self.row_count > 1000000) and not adding.get('filecount'):
+                return
+            if (self.row_count > 1048000):
+                return
         if not adding.get('path'):
             pass
         progress.progress(f"processing {adding['path']}")
         
+        self._emit(adding)
+        self.row_count += 1
+        return adding
+
+    def _emit(self, adding):
         self.data_rows.append(adding)
         
     def save(self):
         if self.output_file.endswith('.xlsx'):
             self.save_as_excel()
+        elif self.output_file.endswith('.parquet'):
+            self.save_as_parquet()
+        elif self.output_file.endswith('.arrow'):
+            self.save_as_arrow()
         else:
             self.save_as_csv()
 
+    # columns stored as dictionaries in parquet/arrow output, they repeat the same few values on every row
+    DICTIONARY_COLUMNS = ['root', 'owner', 'modified_by', 'type', 'permissions', 'direct_permissions']
+
+    def arrow_table(self, rows):
+        """
+        Convert rows to a pyarrow Table with typed columns: sizes and filecount as int64, mtime and mr_mtime
+        as timestamps, permissions and direct_permissions as lists of permission strings, and the
+        DICTIONARY_COLUMNS dictionary encoded.  There is no row limit.
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        int_columns = ['size', 'localsize', 'filecount', 'mr_size']
+        time_columns = ['mtime', 'mr_mtime']
+        list_columns = ['permissions', 'direct_permissions']
+        arrays = []
+        for header in self.write_headers:
+            values = [row.get(header) for row in rows]
+            if header in int_columns:
+                array = pa.array(values, type=pa.int64())
+            elif header in time_columns:
+                array = pc.strptime(pa.array(values, type=pa.string()), format='%Y-%m-%d %H:%M:%S', unit='s')
+            elif header == 'cloud':
+                array = pa.array(values, type=pa.bool_())
+            else:
+                array = pa.array([None if v is None else str(v) for v in values], type=pa.string())
+            if header in list_columns:
+                # "s:, ZU(name)=-ZM, ..." -> ["s:", "ZU(name)=-ZM", ...] with the strings dictionary encoded
+                lists = pc.split_pattern(array, ', ')
+                array = pa.ListArray.from_arrays(lists.offsets, lists.flatten().dictionary_encode(), mask=lists.is_null())
+            elif header in self.DICTIONARY_COLUMNS:
+                array = array.dictionary_encode()
+            arrays.append(array)
+        return pa.Table.from_arrays(arrays, names=self.write_headers)
+
+    def save_as_parquet(self):
+        import pyarrow.parquet as pq
+        pq.write_table(self.arrow_table(self.data_rows), self.output_file, compression='zstd')
+
+    def save_as_arrow(self):
+        import pyarrow as pa
+        table = self.arrow_table(self.data_rows)
+        with pa.OSFile(self.output_file, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
     def save_as_excelx(self):
         data = pd.DataFrame(self.data_rows, columns=self.write_headers)        
         data.to_excel(self.output_file, index=False)
@@ -571,12 +1141,301 @@ class Collector:
             
             # Write the data
             for entry in self.data_rows:
-                row = [str(entry.get(header, '')) for header in self.write_headers]
-                writer.writerow(row)
+                writer.writerow(self.csv_row(entry))
 
+    def csv_row(self, entry):
+        return [str(entry.get(header, '')) for header in self.write_headers]
+
+class StreamingCollector(Collector):
+    """
+    Collector that writes rows to a CSV or parquet file as they are added instead of holding all rows
+    in data_rows until save(), so memory stays flat however large the tree is.  CSV rows are written
+    one at a time; parquet rows are written as a row group every batch_rows rows.
+
+    FileSystemWalker adds a folder's rollup row as soon as the walk of that folder completes, right
+    after the rows of everything beneath it, so rows are written in exactly the order Collector
+    would save them.  There is no Excel row limit.  save() flushes and closes the file.
+    """
+    def __init__(self, output_file='du-default.csv', paths=[], exclude=[], batch_rows=100000):
+        super().__init__(output_file, paths, exclude)
+        self.limit_rows = False
+        self.batch_rows = batch_rows
+        self.parquet_writer = None
+        if output_file.endswith('.csv'):
+            self.file = open(self.output_file, 'w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.write_headers)
+        elif output_file.endswith('.parquet'):
+            self.file = None
+        else:
+            raise ValueError(f"StreamingCollector writes csv or parquet files, not {output_file}")
+
+    def _emit(self, adding):
+        if self.file:
+            self.writer.writerow(self.csv_row(adding))
+        else:
+            self.data_rows.append(adding)
+            if len(self.data_rows) >= self.batch_rows:
+                self._write_row_group()
+
+    def _write_row_group(self):
+        import pyarrow.parquet as pq
+        table = self.arrow_table(self.data_rows)
+        if not self.parquet_writer:
+            self.parquet_writer = pq.ParquetWriter(self.output_file, table.schema, compression='zstd')
+        self.parquet_writer.write_table(table)
+        self.data_rows = []
+
+    def save(self):
+        if self.file:
+            if not self.file.closed:
+                self.file.close()
+            return
+        if self.data_rows or not self.parquet_writer:
+            self._write_row_group()
+        self.parquet_writer.close()
+
+
+def synthetic_drivedata(i, parent_id='parent', folder=False):
+    """Return a dictionary shaped like a files().list() item from a My Drive folder, for benchmarks."""
+    return {
+        'id': f"{i:033d}",
+        'name': f"Document {i}.docx",
+        'mimeType': 'application/vnd.google-apps.folder' if folder else 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'parents': [parent_id],
+        'size': str(1000 + i),
+        'modifiedTime': f"20{10 + i % 15}-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:{i % 59:02d}.{i % 1000:03d}Z",
+        'owners': [{'displayName': f"Owner {i % 20}", 'emailAddress': f"owner{i % 20}@northlakeuu.org"}],
+        'lastModifyingUser': {'displayName': f"Editor {i % 50}", 'emailAddress': f"editor{i % 50}@northlakeuu.org"},
+        'permissions': [
+            {'id': '01', 'role': 'owner', 'type': 'user', 'emailAddress': f"owner{i % 20}@northlakeuu.org"},
+            {'id': '02', 'role': 'writer', 'type': 'group', 'emailAddress': 'board@northlakeuu.org'},
+            {'id': '03', 'role': 'reader', 'type': 'domain', 'domain': 'northlakeuu.org'},
+        ],
+        'webViewLink': f"https://docs.google.com/document/d/{i:033d}/edit",
+    }
+
+def benchmark_entry_memory(count=200000):
+    """Print the memory held per GDEntry built from synthetic files().list() items, as measured by tracemalloc."""
+    import gc
+    import tracemalloc
+    parent = GDEntry(synthetic_drivedata(0, 'root', folder=True))
+    gc.collect()
+    tracemalloc.start()
+    entries = [GDEntry(synthetic_drivedata(i), parent=parent) for i in range(count)]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{count} entries: {used / count:.0f} bytes per entry")
+    return entries
+
+def benchmark_entry_construction(count=1000000, chunk=100000):
+    """
+    Build count GDEntry items from synthetic files().list() items, chunk at a time, the way listfolder()
+    does: constructed with deferred permissions, then resolved together.  Prints the cost per entry of
+    construction, of permission resolution and of reading the lazily computed mtime, and
+    checks that drive_time() agrees with time.mktime(time.strptime()) for every timestamp.
+    """
+    parent = GDEntry(synthetic_drivedata(0, 'root', folder=True))
+    construct = resolve = hydrate = strptime = fast = 0.0
+    mismatches = 0
+    for first in range(0, count, chunk):
+        data = [synthetic_drivedata(i) for i in range(first, min(first + chunk, count))]
+        start = time.perf_counter()
+        entries = [GDEntry(item, parent=parent, defer_permissions=True) for item in data]
+        construct += time.perf_counter() - start
+        start = time.perf_counter()
+        permission_resolver.resolve(entries)
+        resolve += time.perf_counter() - start
+        start = time.perf_counter()
+        for entry in entries:
+            entry.mtime
+        hydrate += time.perf_counter() - start
+
+        times = [item['modifiedTime'] for item in data]
+        start = time.perf_counter()
+        expected = [time.mktime(time.strptime(t, "%Y-%m-%dT%H:%M:%S.%fZ")) for t in times]
+        strptime += time.perf_counter() - start
+        _local_hour.cache_clear()
+        start = time.perf_counter()
+        actual = [drive_time(t) for t in times]
+        fast += time.perf_counter() - start
+        mismatches += sum(a != e for a, e in zip(actual, expected))
+        mismatches += sum(entry.mtime != e for entry, e in zip(entries, expected))
+    us = 1e6 / count
+    print(f"{count} entries: construct {construct * us:.2f} us, resolve permissions {resolve * us:.2f} us, "
+          f"read mtime {hydrate * us:.2f} us per entry")
+    print(f"timestamps: strptime+mktime {strptime * us:.2f} us, drive_time {fast * us:.2f} us per timestamp, "
+          f"{mismatches} mismatches")
+
+def benchmark_rollup(count=2000000, folder_fraction=0.05, seed=1):
+    """
+    Roll up a random tree of count rows with TreeRollup and print the rate, then check TreeRollup against
+    FileSystemWalker on a FakeDrive shared drive and on a small local tree.
+    """
+    rng = np.random.default_rng(seed)
+    is_dir = rng.random(count) < folder_fraction
+    is_dir[0] = True
+    folders = np.flatnonzero(is_dir)
+    # each row goes in a random folder that comes before it
+    before = np.searchsorted(folders, np.arange(count))
+    parent = folders[(rng.random(count) * before).astype(np.int64)]
+    parent[0] = -1
+    size = rng.integers(0, 1 << 30, count)
+    mtime = rng.integers(0, 2000000000, count).astype(np.float64)
+    table = TreeRollup(parent, size, size, mtime, is_dir)
+    start = time.perf_counter()
+    table.rollup()
+    elapsed = time.perf_counter() - start
+    print(f"{count} rows, {len(folders)} folders, depth {table.depths().max()}: rolled up in {elapsed:.2f}s, "
+          f"{count / elapsed / 1e6:.1f} million rows/s")
+
+    import tempfile
+    import random
+    from GDCopy.FakeDrive import FakeDrive
+    global service_pool
+    r = random.Random(seed)
+    drive = FakeDrive()
+    drive_id = drive.add_drive('Bench')
+    top = drive.add_folder('Top', drive_id)
+    def fill(folder, level):
+        for i in range(12):
+            # few distinct times, so ties for the most recent are common
+            drive.add_file('desktop.ini' if i == 11 else f'file{i}.txt', folder, size=r.randint(0, 1000),
+                           modifiedTime=f'2021-0{r.randint(1, 3)}-01T10:00:00.000Z')
+        if level < 4:
+            for j in range(4):
+                fill(drive.add_folder(f'sub{j}', folder), level + 1)
+    fill(top, 0)
+    saved, service_pool = service_pool, GDService.ServicePool(factory=lambda: drive)
+    try:
+        table = rollup_table_from_items(GDService.list_drive_files(drive, drive_id), GDService.get_metadata(drive, top))
+        print(f"FakeDrive: {len(table)} rows, {len(verify_rollup(top, table))} folders differ from the walker")
+    finally:
+        service_pool = saved
+    with tempfile.TemporaryDirectory() as root:
+        make_test_tree(root, 2000, files_per_folder=20, folders_per_folder=4)
+        table = rollup_table_from_scan(root)
+        print(f"local: {len(table)} rows, {len(verify_rollup(root, table))} folders differ from the walker")
+
+def make_test_tree(root, files=1000000, files_per_folder=100, folders_per_folder=10):
+    """Create a tree of empty files under root for benchmarking local scans.  Returns the number of files created."""
+    created = 0
+    folders = [root]
+    while created < files:
+        folder = folders.pop(0)
+        os.makedirs(folder, exist_ok=True)
+        for i in range(min(files_per_folder, files - created)):
+            with open(os.path.join(folder, f"file{i:04d}.dat"), 'wb'):
+                pass
+            created += 1
+        folders.extend(os.path.join(folder, f"dir{i:02d}") for i in range(folders_per_folder))
+    return created
+
+class CountingCollector:
+    """Collector stand-in that only counts rows, so benchmarks measure the walk and not the output."""
+    def __init__(self):
+        self.rows = 0
+
+    def add(self, entry, mostrecent=None, path=None, error=None, filecount=None):
+        self.rows += 1
+
+def benchmark_local_scan(root, files=1000000, max_inflight=16):
+    """Walk root serially and then with max_inflight worker threads, printing the scan rate of each.
+    A tree of `files` empty files is generated under root first if root does not exist."""
+    if not os.path.exists(root):
+        start = time.time()
+        print(f"Created {make_test_tree(root, files)} files under {root} in {time.time() - start:.0f}s")
+    for inflight in [None, max_inflight]:
+        collector = CountingCollector()
+        start = time.time()
+        walker = FileSystemWalker(root, collector, max_inflight=inflight)
+        walker.walk()
+        elapsed = time.time() - start
+        print(f"max_inflight={inflight}: {collector.rows} entries in {elapsed:.1f}s, {collector.rows / elapsed:.0f} entries/s")
+
+def benchmark_original_paths(count=500000, folders_per_folder=3, files_per_folder=20):
+    """
+    Build a synthetic gdcopy_state.json with count entries in a temporary folder and time looking up the
+    original path of every destination id: first by walking the parents chain for each row, as
+    get_original_path used to, and then with the index.  Loading and lookups are timed separately, and
+    the two methods must agree.
+    """
+    import tempfile
+    global original_paths
+    src2dest = {}
+    folders = ['root']
+    next_folder = 0
+    while len(src2dest) < count:
+        parent = folders[next_folder]
+        next_folder += 1
+        for i in range(folders_per_folder + files_per_folder):
+            src_id = f"s{len(src2dest)}"
+            src2dest[src_id] = {'id': src_id, 'name': f"item {i}", 'parents': [parent], 'dest_id': f"d{len(src2dest)}",
+                                'mimeType': 'application/vnd.google-apps.document', 'modifiedTime': '2020-01-01T00:00:00.000Z'}
+            if i < folders_per_folder:
+                folders.append(src_id)
+
+    with tempfile.TemporaryDirectory() as folder:
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            with open('gdcopy_state.json', 'w') as f:
+                json.dump({'src2dest': src2dest, 'shortcuts_to_copy': []}, f)
+
+            start = time.time()
+            with open('gdcopy_state.json', 'r') as f:
+                walked_src2dest = json.load(f)['src2dest']
+            dest2src = {file['dest_id']: file for file in walked_src2dest.values() if file.get('dest_id')}
+            loaded = time.time()
+            walked = {}
+            for dest_id in dest2src:
+                path = []
+                file_id = dest2src[dest_id]['id']
+                while file_id and file_id in walked_src2dest:
+                    path.append(walked_src2dest[file_id]['name'])
+                    parents = walked_src2dest[file_id].get('parents')
+                    file_id = parents[0] if parents else None
+                path.reverse()
+                walked[dest_id] = '/'.join(path)
+            print(f"parents chain per row: load {loaded - start:.1f}s, {len(walked)} lookups {time.time() - loaded:.2f}s")
+
+            original_paths = None
+            start = time.time()
+            get_original_path('')
+            print(f"index: converting the json state and building {time.time() - start:.1f}s")
+            original_paths = None
+            start = time.time()
+            get_original_path('')
+            loaded = time.time()
+            indexed = {dest_id: get_original_path(dest_id) for dest_id in walked}
+            print(f"index: reopening the state store and building {loaded - start:.1f}s, {len(indexed)} lookups {time.time() - loaded:.2f}s, "
+                  f"paths match: {indexed == walked}")
+            original_paths = None
+        finally:
+            os.chdir(cwd)
 
 # test FileSystemWalker with Collector
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['--bench-entries']:
+        benchmark_entry_memory(*[int(arg) for arg in sys.argv[2:3]])
+        sys.exit(0)
+    if sys.argv[1:2] == ['--bench-construct']:
+        # DU-via-GD.py --bench-construct [count]
+        benchmark_entry_construction(*[int(arg) for arg in sys.argv[2:3]])
+        sys.exit(0)
+    if sys.argv[1:2] == ['--bench-rollup']:
+        # DU-via-GD.py --bench-rollup [count]
+        benchmark_rollup(*[int(arg) for arg in sys.argv[2:3]])
+        sys.exit(0)
+    if sys.argv[1:2] == ['--bench-scan']:
+        # DU-via-GD.py --bench-scan <root> [files] [max_inflight]
+        benchmark_local_scan(sys.argv[2], *[int(arg) for arg in sys.argv[3:5]])
+        sys.exit(0)
+    if sys.argv[1:2] == ['--bench-paths']:
+        # DU-via-GD.py --bench-paths [count]
+        benchmark_original_paths(*[int(arg) for arg in sys.argv[2:3]])
+        sys.exit(0)
     
     for path, output_file, exclude in [
                 #('G:\\Shared drives\\Photographs', 'xls/du-photographs.xlsx'),
@@ -616,10 +1475,17 @@ if __name__ == '__main__':
         if not isinstance(path, list):
             path = [path]
         collector = Collector(output_file, path, exclude)
-        for p in path:                
-            walker = FileSystemWalker(p, collector)
+        walkers = []
+        for index, p in enumerate(path):
+            # rerunning after a crash resumes from the checkpoint instead of starting over
+            checkpoint_file = output_file + (f'.{index}' if len(path) > 1 else '') + '.checkpoint'
+            walker = FileSystemWalker(p, collector, checkpoint_file=checkpoint_file)
             walker.walk()
+            walkers.append(walker)
         collector.save()
+        # only now is there nothing left to resume
+        for walker in walkers:
+            walker.remove_checkpoint()
         print('Done*******************  ', output_file)
 
     
\ No newline at end of file
@@ -0,0 +1,413 @@
+"""
+In-memory stand-in for the Google Drive v3 service returned by GDService.authenticate().
+
+FakeDrive implements the subset of files(), permissions(), comments() and replies() used by DU-via-GD and GDCopy so
+that walkers and copiers can be exercised and benchmarked without network access or credentials.
+Every execute() is counted in FakeDrive.calls (keyed by 'resource.method') and can be delayed by
+`latency` seconds to simulate a round trip.  Setting `fail_after` makes every round trip after that
+many raise FakeDriveError, to simulate a walk or copy dying part way through.  inject_errors() makes the
+next round trips fail with a given HttpError, such as a 403 rateLimitExceeded, and with batch=True the
+next calls inside batches instead.  Like Drive, files().get
+and files().list return only the fields named in `fields`.  The fake is thread safe.
+
+Example:
+    drive = FakeDrive(latency=0.01)
+    top = drive.add_folder('Top', drive_id='0AFake')
+    drive.add_file('notes.txt', top, size=120)
+    files = GDService.list_files(drive, top, drive_id='0AFake')
+"""
+import re
+import json
+import time
+import threading
+import itertools
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+
+def parse_fields(fields):
+    """Parse a field mask such as "nextPageToken, files(id, owners(displayName))" into {name: sub mask or None}."""
+    mask = {}
+    pos = 0
+    def parse(mask, stop):
+        nonlocal pos
+        name = ''
+        while pos < len(fields) and fields[pos] != stop:
+            c = fields[pos]
+            pos += 1
+            if c == '(':
+                sub = mask[name.strip()] = {}
+                parse(sub, ')')
+                pos += 1  # past the ')'
+                name = ''
+            elif c == ',':
+                if name.strip():
+                    mask.setdefault(name.strip(), None)
+                name = ''
+            else:
+                name += c
+        if name.strip():
+            mask.setdefault(name.strip(), None)
+    parse(mask, None)
+    # a/b selects b within a
+    for name in [name for name in mask if '/' in name]:
+        outer, inner = name.split('/', 1)
+        sub = mask.pop(name)
+        mask.setdefault(outer, {})
+        if mask[outer] is not None:
+            mask[outer][inner] = sub
+    return mask
+
+def project(value, mask):
+    """The parts of value, a resource or list of resources, selected by a parsed field mask."""
+    if mask is None:
+        return value
+    if isinstance(value, list):
+        return [project(v, mask) for v in value]
+    if not isinstance(value, dict):
+        return value
+    return {k: project(value[k], sub) for k, sub in mask.items() if k in value}
+
+class FakeDriveError(Exception):
+    """Raised by every round trip once FakeDrive.fail_after calls have been made."""
+
+class FakeRequest:
+    """Deferred call, mirroring googleapiclient.http.HttpRequest.execute()."""
+    def __init__(self, drive, method, fn):
+        self.drive = drive
+        self.method = method
+        self.fn = fn
+
+    def execute(self):
+        self.drive._round_trip(self.method)
+        return self.fn()
+
+class FakeDrive:
+    def __init__(self, latency=0.0, page_size=100, fail_after=None):
+        self.latency = latency
+        self.fail_after = fail_after
+        self.page_size = page_size
+        self.items = {}         # file id -> metadata dict as returned by files().get
+        self.grants = {}        # file id -> list of permissions granted directly on the item
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.change_log = []    # file ids in the order they were created or modified, see changes()
+        self.errors = []        # HttpErrors to raise from the next round trips, see inject_errors()
+        self.batch_errors = []  # HttpErrors to return from the next calls inside batches
+        self.file_comments = {} # file id -> list of comment dicts, each with a 'replies' list
+
+    # ---------------------------------------------------------------- tree building
+    def _new_id(self, prefix='f'):
+        return f"{prefix}{next(self._ids):06d}"
+
+    def add_drive(self, name, grants=None):
+        """Create a shared drive; the drive root is a folder whose id is the drive id."""
+        drive_id = self._new_id('0A')
+        self.items[drive_id] = {'id': drive_id, 'name': name, 'mimeType': FOLDER_MIME, 'parents': [],
+                                'modifiedTime': '2020-01-01T00:00:00.000Z', 'driveId': drive_id}
+        self.grants[drive_id] = grants or []
+        return drive_id
+
+    def add_folder(self, name, parent=None, drive_id=None, **fields):
+        return self.add_file(name, parent, mimeType=FOLDER_MIME, drive_id=drive_id, **fields)
+
+    def add_file(self, name, parent=None, size=None, modifiedTime='2020-01-01T00:00:00.000Z',
+                 mimeType='application/octet-stream', drive_id=None, grants=None, **fields):
+        file_id = self._new_id()
+        if drive_id is None and parent in self.items:
+            drive_id = self.items[parent].get('driveId')
+        item = {'id': file_id, 'name': name, 'mimeType': mimeType, 'parents': [parent] if parent else [],
+                'modifiedTime': modifiedTime, 'trashed': False,
+                'owners': [{'displayName': 'Owner', 'emailAddress': 'owner@example.org'}],
+                'lastModifyingUser': {'displayName': 'Editor', 'emailAddress': 'editor@example.org'}}
+        if size is not None and mimeType != FOLDER_MIME:
+            item['size'] = str(size)
+        if drive_id:
+            item['driveId'] = drive_id
+        item.update(fields)
+        self.items[file_id] = item
+        self.grants[file_id] = grants or []
+        self.change_log.append(file_id)
+        return file_id
+
+    def update_item(self, file_id, **fields):
+        """Modify an item in place, recording a change for the changes feed."""
+        self.items[file_id].update(fields)
+        self.change_log.append(file_id)
+
+    def add_comment(self, file_id, content, author='Author', createdTime='2020-01-01T00:00:00.000Z', replies=()):
+        """Attach a comment, with replies given as a list of reply content strings."""
+        comment = {'id': self._new_id('c'), 'content': content, 'createdTime': createdTime,
+                   'modifiedTime': createdTime, 'resolved': False,
+                   'author': {'displayName': author, 'emailAddress': f'{author.lower()}@example.org'},
+                   'replies': [{'id': self._new_id('r'), 'content': reply, 'createdTime': createdTime,
+                                'modifiedTime': createdTime, 'author': {'displayName': author}}
+                               for reply in replies]}
+        self.file_comments.setdefault(file_id, []).append(comment)
+        return comment['id']
+
+    # ---------------------------------------------------------------- permissions
+    def _ancestors(self, file_id):
+        """Yield file_id and then each of its ancestors, nearest first."""
+        seen = set()
+        while file_id and file_id in self.items and file_id not in seen:
+            seen.add(file_id)
+            yield file_id
+            parents = self.items[file_id].get('parents')
+            file_id = parents[0] if parents else None
+
+    def effective_permissions(self, file_id):
+        """Permissions of file_id including those inherited from its ancestors, with permissionDetails."""
+        merged = {}
+        for ancestor in self._ancestors(file_id):
+            is_drive_root = ancestor == self.items[ancestor].get('driveId')
+            for grant in self.grants.get(ancestor, []):
+                perm = merged.setdefault(grant['id'], dict(grant, permissionDetails=[]))
+                perm['permissionDetails'].append({
+                    'inherited': ancestor != file_id,
+                    'inheritedFrom': ancestor if ancestor != file_id else None,
+                    'role': grant['role'],
+                    'permissionType': 'member' if is_drive_root else 'file',
+                })
+        return list(merged.values())
+
+    def _view(self, item):
+        """Return a copy of item as files().list/get would, filling in computed fields."""
+        view = dict(item)
+        if item.get('driveId'):
+            view['hasAugmentedPermissions'] = bool(self.grants.get(item['id']))
+        else:
+            view['permissions'] = [{k: v for k, v in p.items() if k != 'permissionDetails'}
+                                   for p in self.effective_permissions(item['id'])]
+        return view
+
+    # ---------------------------------------------------------------- call accounting
+    def inject_errors(self, status, reason=None, count=1, retry_after=None, batch=False):
+        """
+        Make the next count round trips raise an HttpError with the given status, Drive reason and Retry-After.
+        With batch the batch round trips succeed and the next count calls inside them fail instead.
+        """
+        headers = {'status': str(status)}
+        if retry_after is not None:
+            headers['retry-after'] = str(retry_after)
+        content = json.dumps({'error': {'code': status, 'message': reason or 'error',
+                                        'errors': [{'reason': reason}] if reason else []}}).encode('utf-8')
+        with self.lock:
+            (self.batch_errors if batch else self.errors).extend(HttpError(httplib2.Response(headers), content) for _ in range(count))
+
+    def _round_trip(self, method):
+        with self.lock:
+            if self.fail_after is not None and self._total_calls() >= self.fail_after:
+                raise FakeDriveError(f"{method} failed after {self.fail_after} calls")
+            self.calls[method] += 1
+            error = self.errors.pop(0) if self.errors else None
+        if error:
+            raise error
+        if self.latency:
+            time.sleep(self.latency)
+
+    def total_calls(self):
+        """Number of round trips; calls made inside a batch are counted under 'batch.*' but not here."""
+        with self.lock:
+            return self._total_calls()
+
+    def _total_calls(self):
+        return sum(count for method, count in self.calls.items() if not method.startswith('batch.'))
+
+    # ---------------------------------------------------------------- resources
+    def files(self):
+        return _Files(self)
+
+    def permissions(self):
+        return _Permissions(self)
+
+    def changes(self):
+        return _Changes(self)
+
+    def comments(self):
+        return _Comments(self)
+
+    def replies(self):
+        return _Replies(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+class FakeBatch:
+    """Batch request, mirroring googleapiclient.http.BatchHttpRequest.  One round trip for the whole batch."""
+    def __init__(self, drive, callback=None):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self.requests) >= 100:
+            raise ValueError("Exceeded the maximum of 100 calls in a single batch.")
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self):
+        self.drive._round_trip('batch')
+        for request_id, request, callback in self.requests:
+            with self.drive.lock:
+                self.drive.calls['batch.' + request.method] += 1
+                error = self.drive.batch_errors.pop(0) if self.drive.batch_errors else None
+            try:
+                if error:
+                    raise error
+                response, exception = request.fn(), None
+            except Exception as error:
+                response, exception = None, error
+            if callback:
+                callback(request_id, response, exception)
+
+class _Files:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def get(self, fileId, fields=None, supportsAllDrives=None, **kwargs):
+        def run():
+            if fileId not in self.drive.items:
+                raise KeyError(f"File not found: {fileId}")
+            view = self.drive._view(self.drive.items[fileId])
+            return project(view, parse_fields(fields)) if fields else view
+        return FakeRequest(self.drive, 'files.get', run)
+
+    def list(self, q='', pageToken=None, pageSize=None, corpora=None, driveId=None, fields=None, **kwargs):
+        def run():
+            parent = re.search(r"'([^']+)' in parents", q or '')
+            with self.drive.lock:
+                items = [i for i in self.drive.items.values() if i['parents']]
+            if parent:
+                items = [i for i in items if parent.group(1) in i['parents']]
+            if corpora == 'drive' and driveId:
+                items = [i for i in items if i.get('driveId') == driveId]
+            if 'trashed = false' in (q or ''):
+                items = [i for i in items if not i.get('trashed')]
+            start = int(pageToken or 0)
+            count = min(pageSize or self.drive.page_size, 1000)
+            result = {'files': [self.drive._view(i) for i in items[start:start + count]]}
+            if start + count < len(items):
+                result['nextPageToken'] = str(start + count)
+            return project(result, parse_fields(fields)) if fields else result
+        return FakeRequest(self.drive, 'files.list', run)
+
+    def copy(self, fileId, body=None, fields=None, supportsAllDrives=None, **kwargs):
+        def run():
+            source = self.drive.items[fileId]
+            body_ = body or {}
+            parent = (body_.get('parents') or source['parents'] or [None])[0]
+            fields_ = {k: v for k, v in source.items() if k not in ('id', 'name', 'parents', 'driveId', 'mimeType')}
+            fields_.update({k: v for k, v in body_.items() if k not in ('name', 'parents')})
+            with self.drive.lock:
+                file_id = self.drive.add_file(body_.get('name', source['name']), parent,
+                                              mimeType=source['mimeType'], **fields_)
+            return {'id': file_id, 'name': self.drive.items[file_id]['name']}
+        return FakeRequest(self.drive, 'files.copy', run)
+
+    def create(self, body=None, fields=None, supportsAllDrives=None, **kwargs):
+        def run():
+            body_ = dict(body or {})
+            name = body_.pop('name')
+            parent = (body_.pop('parents', None) or [None])[0]
+            with self.drive.lock:
+                file_id = self.drive.add_file(name, parent, **body_)
+            return {'id': file_id}
+        return FakeRequest(self.drive, 'files.create', run)
+
+    def update(self, fileId, body=None, addParents=None, removeParents=None, fields=None, supportsAllDrives=None, **kwargs):
+        def run():
+            with self.drive.lock:
+                item = self.drive.items[fileId]
+                parents = [p for p in item['parents'] if p not in (removeParents or '').split(',')]
+                parents += [p for p in (addParents or '').split(',') if p and p not in parents]
+                self.drive.update_item(fileId, parents=parents, **(body or {}))
+            return {'id': fileId, 'modifiedTime': self.drive.items[fileId].get('modifiedTime')}
+        return FakeRequest(self.drive, 'files.update', run)
+
+    def delete(self, fileId, supportsAllDrives=None, **kwargs):
+        def run():
+            with self.drive.lock:
+                del self.drive.items[fileId]
+            return ''
+        return FakeRequest(self.drive, 'files.delete', run)
+
+class _Permissions:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, fileId, fields=None, supportsAllDrives=None, **kwargs):
+        def run():
+            return {'permissions': self.drive.effective_permissions(fileId)}
+        return FakeRequest(self.drive, 'permissions.list', run)
+
+class _Changes:
+    """Changes feed.  A page token is an index into FakeDrive.change_log."""
+    def __init__(self, drive):
+        self.drive = drive
+
+    def getStartPageToken(self, driveId=None, supportsAllDrives=None, **kwargs):
+        return FakeRequest(self.drive, 'changes.getStartPageToken',
+                           lambda: {'startPageToken': str(len(self.drive.change_log))})
+
+    def list(self, pageToken, driveId=None, pageSize=None, fields=None, **kwargs):
+        def run():
+            start = int(pageToken)
+            count = pageSize or self.drive.page_size
+            changes = []
+            for file_id in self.drive.change_log[start:start + count]:
+                item = self.drive.items[file_id]
+                if driveId and item.get('driveId') != driveId:
+                    continue
+                changes.append({'fileId': file_id, 'removed': False, 'file': self.drive._view(item)})
+            result = {'changes': changes}
+            if start + count < len(self.drive.change_log):
+                result['nextPageToken'] = str(start + count)
+            else:
+                result['newStartPageToken'] = str(len(self.drive.change_log))
+            return result
+        return FakeRequest(self.drive, 'changes.list', run)
+
+class _Comments:
+    """Comments on a file.  Paged like files().list, with pageToken an index into the file's comments."""
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, fileId, pageToken=None, pageSize=None, fields=None, **kwargs):
+        def run():
+            comments = self.drive.file_comments.get(fileId, [])
+            start = int(pageToken or 0)
+            count = min(pageSize or 20, 100)
+            result = {'comments': [dict(c, replies=list(c['replies'])) for c in comments[start:start + count]]}
+            if start + count < len(comments):
+                result['nextPageToken'] = str(start + count)
+            return result
+        return FakeRequest(self.drive, 'comments.list', run)
+
+    def create(self, fileId, body=None, fields=None, **kwargs):
+        def run():
+            with self.drive.lock:
+                comment = dict(body or {}, id=self.drive._new_id('c'), replies=[],
+                               author={'displayName': 'Migration', 'emailAddress': 'migration@example.org'})
+                comment.setdefault('modifiedTime', comment.get('createdTime', '2020-01-01T00:00:00.000Z'))
+                self.drive.file_comments.setdefault(fileId, []).append(comment)
+            return {k: v for k, v in comment.items() if k != 'replies'}
+        return FakeRequest(self.drive, 'comments.create', run)
+
+class _Replies:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def create(self, fileId, commentId, body=None, fields=None, **kwargs):
+        def run():
+            with self.drive.lock:
+                reply = dict(body or {}, id=self.drive._new_id('r'),
+                             author={'displayName': 'Migration', 'emailAddress': 'migration@example.org'})
+                reply.setdefault('modifiedTime', reply.get('createdTime', '2020-01-01T00:00:00.000Z'))
+                comment = next(c for c in self.drive.file_comments[fileId] if c['id'] == commentId)
+                comment['replies'].append(reply)
+            return reply
+        return FakeRequest(self.drive, 'replies.create', run)
@@ -4,11 +4,13 @@ import logging
 import time
 import json
 import sys
+import threading
 
 
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from GDService import authenticate, retry_request
+from GDService import authenticate, retry_request, rate_limiter, batch_execute, ServicePool, iter_files
+import GDState
 
 # DRY_RUN is a flag that can be set to True to prevent any changes from being made.
 DRY_RUN = False
@@ -31,7 +33,7 @@ post_logger.info(f"*****************************\nPost processing started at {ti
 # Function to remove a file from Google Drive, including files on Shared Drives
 def remove_file(drive_service, file_id):
     try:
-        drive_service.files().delete(fileId=file_id, supportsAllDrives=True).execute()
+        rate_limiter.execute(drive_service.files().delete(fileId=file_id, supportsAllDrives=True))
         logger.info(f"File with ID {file_id} has been removed successfully.")
         return None
     except Exception as error:
@@ -41,11 +43,11 @@ def remove_file(drive_service, file_id):
 def get_file(service, file_id):
 
     try:
-        file = service.files().get(
+        file = rate_limiter.execute(service.files().get(
             fileId=file_id,
             supportsAllDrives=True,
             fields="id, name, mimeType, size, parents, modifiedTime, createdTime, description, starred, trashed, webViewLink, webContentLink, owners, permissions"
-        ).execute()
+        ))
 
         #print(f"File ID: {file['id']}")
         #print(f"File Name: {file['name']}")
@@ -66,61 +68,15 @@ def get_file(service, file_id):
         print(f"An error occurred: {error}")
         return None
     
-def list_files(service, folder_id, drive_id=None):
-    """List all files in the given folder, handling pagination."""
-    query = f"'{folder_id}' in parents"
-    items = []
-    page_token = None
-
-    while True:
-        if drive_id:
-            corpora = 'drive'
-        else:
-            corpora = 'user'
-        
-        results = service.files().list(
-            q=query,
-            spaces='drive',
-            corpora=corpora,
-            driveId=drive_id,
-            includeItemsFromAllDrives=True,
-            supportsAllDrives=True,
-            fields="nextPageToken, files(id, name, mimeType, parents, modifiedTime, createdTime, description, starred, viewersCanCopyContent, writersCanShare, trashed, shortcutDetails)",
-            pageToken=page_token
-        ).execute()
-        items.extend(results.get('files', []))
-        page_token = results.get('nextPageToken', None)
-        if page_token is None:
-            break
+def list_files(service, folder_id, drive_id=None, additional_fields=None, profile='copy'):
+    """
+    List all files in the given folder, trashed ones included, handling pagination.  Each file has the
+    fields of the GDService profile, 'copy' by default, with any additional_fields, e.g. "webViewLink", added.
+    """
+    return list(iter_files(service, folder_id, drive_id, additional_fields, profile, include_trashed=True))
 
-    return items
 def lft(service, folder_id, drive_id=None):
-    query = f"'{folder_id}' in parents"
-    items = []
-    page_token = None
-
-    while True:
-        if drive_id:
-            corpora = 'drive'
-        else:
-            corpora = 'user'
-        
-        results = service.files().list(
-            q=query,
-            spaces='drive',
-            corpora=corpora,
-            driveId=drive_id,
-            includeItemsFromAllDrives=True,
-            supportsAllDrives=True,
-            fields="nextPageToken, files(id, name, mimeType, parents, modifiedTime, createdTime, description, starred, viewersCanCopyContent, writersCanShare, trashed)",
-            pageToken=page_token
-        ).execute()
-        items.extend(results.get('files', []))
-        page_token = results.get('nextPageToken', None)
-        if page_token is None:
-            break
-
-    return items
+    return list_files(service, folder_id, drive_id)
 
 
 def copy_file(service, file_id, parent_folder_id, file_metadata, drive_id=None):
@@ -147,34 +103,100 @@ def copy_file_item(service, file, parent_folder_id, file_metadata, drive_id=None
     copied = retry_request(service.files().copy, fileId=file_id, body=copied_file, supportsAllDrives=True)
     return copied
 
+def list_comments(drive_service, file_id):
+    """List all the comments on a file, with their replies, handling pagination."""
+    comments = []
+    page_token = None
+    while True:
+        result = retry_request(drive_service.comments().list, fileId=file_id, pageSize=100, pageToken=page_token,
+                               fields="nextPageToken, comments(id, content, author, createdTime, modifiedTime, resolved, replies(author, content, createdTime, modifiedTime))")
+        comments.extend(result.get('comments', []))
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+    return comments
+
+def comment_content(comment):
+    # Include author information, resolved status, and modified time in the comment content
+    return f"Original author: {comment['author']['displayName']}\nResolved: {comment.get('resolved', False)}\nModified: {comment['modifiedTime']}\n{comment['content']}"
+
+def reply_content(reply):
+    # Include author information and modified time in the reply content
+    return f"Original author: {reply['author']['displayName']}\nModified: {reply['modifiedTime']}\n{reply['content']}"
+
 def copy_comments(drive_service, source_file_id, target_file_id):
-    """Copy comments from the source file to the target file."""
-    comments = retry_request(drive_service.comments().list, fileId=source_file_id, fields="comments(content, author, createdTime, modifiedTime, resolved, replies(author, content, createdTime, modifiedTime))")
-    comment_count = 0
-    if 'comments' in comments:
-        for comment in comments['comments']:
-            comment_count += 1
-            # Include author information, resolved status, and modified time in the comment content
-            copied_comment = {
-                'content': f"Original author: {comment['author']['displayName']}\nResolved: {comment.get('resolved', False)}\nModified: {comment['modifiedTime']}\n{comment['content']}",
-                'createdTime': comment['createdTime']
-            }
-            new_comment = retry_request(drive_service.comments().create, fileId=target_file_id, body=copied_comment, fields="id, content, createdTime")
-            logger.info(f"Copied comment: {copied_comment['content']}")
-
-            # Now copy the replies
-            if 'replies' in comment:
-                for reply in comment['replies']:
-                    # Include author information and modified time in the reply content
-                    copied_reply = {
-                        'content': f"Original author: {reply['author']['displayName']}\nModified: {reply['modifiedTime']}\n{reply['content']}",
-                        'createdTime': reply['createdTime']
-                    }
-                    retry_request(drive_service.replies().create, fileId=target_file_id, commentId=new_comment['id'], body=copied_reply, fields="id, content, createdTime")
-                    logger.info(f"Copied reply: {copied_reply['content']}")
-    else:
+    """
+    Copy comments from the source file to the target file, returning the number of comments on the source.
+
+    Comments and replies already on the target with the content a copy would have are not created again,
+    so an interrupted copy can simply be rerun.  The missing top level comments are created with batch
+    requests, and replies in rounds, the first reply of every comment in one batch, then the second, so
+    that each thread keeps its order.  A thread whose reply fails gets no further replies this run.
+    """
+    comments = list_comments(drive_service, source_file_id)
+    if not comments:
         logger.info(f"No comments found in file ID: {source_file_id}")
-    return comment_count
+        return 0
+
+    existing = {}   # content -> comments already on the target
+    for comment in list_comments(drive_service, target_file_id):
+        existing.setdefault(comment['content'], []).append(comment)
+
+    threads = []    # (source comment, target comment id, reply contents already on the target comment)
+    new_comments = []
+    for comment in comments:
+        copies = existing.get(comment_content(comment))
+        if copies:
+            copied = copies.pop(0)
+            threads.append((comment, copied['id'], [reply['content'] for reply in copied.get('replies', [])]))
+        else:
+            new_comments.append(comment)
+
+    requests = [(index, drive_service.comments().create(fileId=target_file_id, fields="id, content, createdTime",
+                                                        body={'content': comment_content(comment), 'createdTime': comment['createdTime']}))
+                for index, comment in enumerate(new_comments)]
+    results = batch_execute(drive_service, requests)
+    for index, comment in enumerate(new_comments):
+        new_comment, error = results.get(index, (None, 'no response'))
+        if error:
+            logger.error(f"Copy comment failed on {target_file_id}: {error}")
+            post_logger.error(f"Copy comment failed on {target_file_id}: {error}")
+            continue
+        logger.info(f"Copied comment: {new_comment['content']}")
+        threads.append((comment, new_comment['id'], []))
+
+    # Now copy the replies, leaving out those already on the target comment
+    pending = []
+    for comment, target_comment_id, existing_replies in threads:
+        replies = []
+        for reply in comment.get('replies', []):
+            content = reply_content(reply)
+            if content in existing_replies:
+                existing_replies.remove(content)
+            else:
+                replies.append({'content': content, 'createdTime': reply['createdTime']})
+        if replies:
+            pending.append((target_comment_id, replies))
+
+    reply_index = 0
+    while pending:
+        requests = [(target_comment_id, drive_service.replies().create(fileId=target_file_id, commentId=target_comment_id, body=replies[reply_index],
+                                                                       fields="id, content, createdTime"))
+                    for target_comment_id, replies in pending]
+        results = batch_execute(drive_service, requests)
+        still_pending = []
+        for target_comment_id, replies in pending:
+            copied_reply, error = results.get(target_comment_id, (None, 'no response'))
+            if error:
+                logger.error(f"Copy reply failed on {target_file_id} comment {target_comment_id}: {error}")
+                post_logger.error(f"Copy reply failed on {target_file_id} comment {target_comment_id}: {error}")
+                continue
+            logger.info(f"Copied reply: {replies[reply_index]['content']}")
+            if len(replies) > reply_index + 1:
+                still_pending.append((target_comment_id, replies))
+        pending = still_pending
+        reply_index += 1
+    return len(comments)
 
 tfile_count = 0
 tfolder_count = 0
@@ -285,43 +307,268 @@ def remove_files(drive_service,drive_id=None):
 shortcut2target_folder = [] # list of source shortcut id and destination parent folder id.  Will create a shortcut in the destination folder after all processing is done
 src2dest = {} # key is the source id.  value is src:file and dst:file which is the respective src and dst file object
 
+class ShortcutResolver:
+    """
+    Recreates copied shortcuts in the destination, pointing at the copies of their targets.
+
+    A shortcut can only be recreated once its target has been copied, which may be later in the same run
+    or in a later migration.  Each queued shortcut waits on the source id of its target.  record_dest()
+    calls notify() as items are copied, which makes the shortcuts waiting on that item ready.  Ready
+    shortcuts are created with batch requests of up to batch_size, as soon as a full batch is ready, and
+    the rest when flush(force=True) is called.  A created shortcut is recorded in src2dest with its new id
+    and removed from shortcut2target_folder, so reruns do not create it again.  Shortcuts whose targets
+    have not been copied stay queued, and are created by whichever later run copies the target.  A
+    shortcut queued by an earlier run is reached again by the copy, so add() ignores shortcuts it already has.
+    """
+    def __init__(self, drive_service, batch_size=100):
+        self.drive_service = drive_service
+        self.batch_size = batch_size
+        self.waiting = {}   # target source id -> [(shortcut item, destination folder id)]
+        self.ready = []     # (shortcut item, destination folder id, target destination id)
+        self.queued = set() # source ids of the shortcuts added
+        self.created = 0
+        self.failed = 0
+        for shortcut_id, dest_folder_id in list(shortcut2target_folder):
+            self.add(shortcut_id, dest_folder_id)
+
+    def add(self, shortcut_id, dest_folder_id):
+        """Queue the shortcut with source id shortcut_id to be recreated in dest_folder_id."""
+        if shortcut_id in self.queued:
+            return
+        item = src2dest.get(shortcut_id)
+        if not item or 'shortcutDetails' not in item:
+            logger.error(f"Fix Shortcut: {shortcut_id} not found in src2dest map.")
+            post_logger.error(f"Fix Shortcut: {shortcut_id} not found in src2dest map.")
+            return
+        if item.get('dest_id'):
+            # created by an earlier run that did not get to dequeue it
+            self.dequeue(shortcut_id, dest_folder_id)
+            return
+        self.queued.add(shortcut_id)
+        target_id = item['shortcutDetails']['targetId']
+        target = src2dest.get(target_id)
+        if target and target.get('dest_id'):
+            self.ready.append((item, dest_folder_id, target['dest_id']))
+            self.flush()
+        else:
+            self.waiting.setdefault(target_id, []).append((item, dest_folder_id))
+
+    def notify(self, src_id, dest_id):
+        """src_id has been copied to dest_id; shortcuts waiting on it are ready."""
+        if dest_id and src_id in self.waiting:
+            for item, dest_folder_id in self.waiting.pop(src_id):
+                self.ready.append((item, dest_folder_id, dest_id))
+            self.flush()
+
+    def flush(self, force=False):
+        """Create ready shortcuts a batch at a time; unless force, only while a full batch is ready."""
+        while self.ready and (force or len(self.ready) >= self.batch_size):
+            chunk = self.ready[:self.batch_size]
+            self.ready = self.ready[self.batch_size:]
+            if DRY_RUN:
+                for item, dest_folder_id, target_id in chunk:
+                    logger.info(f"Fix Shortcut: would create {item['name']} {item['id']} in {dest_folder_id} pointing at {target_id}")
+                    post_logger.info(f"Fix Shortcut: would create {item['name']} {item['id']} in {dest_folder_id} pointing at {target_id}")
+                continue
+            requests = []
+            for index, (item, dest_folder_id, target_id) in enumerate(chunk):
+                new_shortcut = {
+                    'name': item['name'],
+                    'mimeType': 'application/vnd.google-apps.shortcut',
+                    'shortcutDetails': {
+                        'targetId': target_id
+                    },
+                    'parents': [dest_folder_id]
+                }
+                requests.append((index, self.drive_service.files().create(body=new_shortcut, supportsAllDrives=True, fields='id')))
+            results = batch_execute(self.drive_service, requests)
+            for index, (item, dest_folder_id, target_id) in enumerate(chunk):
+                copied_shortcut, error = results.get(index, (None, 'no response'))
+                if error:
+                    # stays queued for the next run
+                    self.failed += 1
+                    logger.error(f"Fix Shortcut: {item['name']} {item['id']} failed: {error}")
+                    post_logger.error(f"Fix Shortcut: {item['name']} {item['id']} failed: {error}")
+                    continue
+                self.created += 1
+                post_logger.info(f"Copied shortcut: {item['name']} {item['shortcutDetails']['targetId']} to {target_id} {copied_shortcut}")
+                record_dest(item, copied_shortcut['id'])
+                self.dequeue(item['id'], dest_folder_id)
+
+    @staticmethod
+    def dequeue(shortcut_id, dest_folder_id):
+        """Remove the shortcut from shortcut2target_folder so later runs do not load it again."""
+        try:
+            shortcut2target_folder.remove([shortcut_id, dest_folder_id])
+        except ValueError:
+            pass  # a list that no longer holds it
+
+    def report(self):
+        waiting = sum(len(shortcuts) for shortcuts in self.waiting.values())
+        return (f"Shortcuts: {self.created} created, {self.failed} failed, {waiting} waiting for "
+                f"{len(self.waiting)} targets to be copied")
+
+shortcut_resolver = None # set while copying so that shortcuts are created as soon as their targets are copied
+
+def shortcut_dest(item):
+    """The id of the shortcut an earlier run created for the source shortcut item, otherwise None."""
+    if item['mimeType'] != 'application/vnd.google-apps.shortcut':
+        return None
+    previous = src2dest.get(item['id'])
+    return previous.get('dest_id') if previous else None
+
+def queue_shortcut(item, dest_folder_id):
+    """Queue the source shortcut item to be recreated in dest_folder_id once its target has been copied."""
+    if item.get('dest_id'):
+        return  # created by an earlier run
+    if shortcut_resolver and item['id'] in shortcut_resolver.queued:
+        return  # queued by an earlier run, already in shortcut2target_folder
+    shortcut2target_folder.append([item['id'], dest_folder_id])
+    post_logger.info(f"Shortcut: {item}")
+    if shortcut_resolver:
+        shortcut_resolver.add(item['id'], dest_folder_id)
+
 def fix_shortcuts(drive_service):
-    # for each of shortcuts, get the shortcutID from the details, update the targetid to the new targetid from the src2dest map and create a shortcut in the destination folder
-    for shortcut in shortcut2target_folder:
-        shortcut_id, dest_folder_id = shortcut
-        shortcut_name = src2dest[shortcut_id]['name']
-        oldtarget_id = src2dest[shortcut_id]['shortcutDetails']['targetId']
-
-        if oldtarget_id in src2dest:
-            new_target_id = src2dest[oldtarget_id]['dest_id'] # get the new target id from the src2dest map
-            if new_target_id is None:
-                logger.error(f"Target ID {oldtarget_id} not found in src2dest map.")
-                post_logger.error(f"Target ID {oldtarget_id} not found in src2dest map.")
+    """Create every queued shortcut whose target has been copied; the others stay queued for a later run."""
+    resolver = shortcut_resolver or ShortcutResolver(drive_service)
+    resolver.flush(force=True)
+    logger.info(resolver.report())
+    post_logger.info(resolver.report())
+    for target_id, shortcuts in resolver.waiting.items():
+        for item, dest_folder_id in shortcuts:
+            post_logger.info(f"Fix Shortcut: {item['name']} {item['id']} waiting for target {target_id} to be copied")
+
+def copy_file_with_metadata(drive_service, item, dest_folder_id, drive_id=None):
+    """
+    Copy a file into dest_folder_id along with its comments, then restore its modifiedTime.  Returns the copied file.
+    Once files().copy has succeeded the copy is returned even if its comments or modifiedTime fail, so that
+    it is recorded and not copied again; those are logged and left to fix_copy_comments() and
+    fix_update_modified_time().
+    """
+    copied_file = copy_file(drive_service, item['id'], dest_folder_id, item, drive_id)
+    if copied_file:
+        logger.info(f"Copied file: {item['name']} (ID: {copied_file['id']})")
+        post_logger.info(f"Copied: {item['name']} {copied_file}")
+        try:
+            # Copy the comments if this mime type supports comments.
+            if item['mimeType'] in [
+                    "application/vnd.google-apps.document",
+                    "application/vnd.google-apps.spreadsheet",
+                    "application/vnd.google-apps.presentation",
+                    "application/vnd.google-apps.drawing"
+                ]:
+                copy_comments(drive_service, item['id'], copied_file['id'])
+                # updating the modified time after copying comments may not work if applied right away.
+                # probably should collect these ids for later processing.  At least this copy in 
+                # the post_logger data will be relatively easy to turn into a list of ids to process.
+                # discovered this while copying the board folder.  The modifiedTime was not updated on many
+                # files that had comments
+                post_logger.warning(f"Copied comments: modifiedTime may be wrong {copied_file['id']}")
+
+            # Update modified time after copying comments if they exist
+            update_file = {}
+            if 'modifiedTime' in item:
+                update_file['modifiedTime'] = item['modifiedTime']
+            if update_file:
+                update = retry_request(drive_service.files().update, fileId=copied_file['id'], body=update_file, fields='id, modifiedTime', supportsAllDrives=True)
+                post_logger.warning(f"Updated: {item['name']} {update_file} {update}")
+        except Exception as error:
+            logger.error(f"Copied {item['name']} (ID: {copied_file['id']}) but its comments or modifiedTime failed: {error}")
+            post_logger.error(f"Fix-up needed: {item['name']} {copied_file['id']} comments or modifiedTime failed: {error}")
+    return copied_file
+
+def record_dest(item, dest_id):
+    """Record in src2dest that the source item is at dest_id, None if it has not been copied.  With a state store the write is durable at once."""
+    item['dest_id'] = dest_id
+    src2dest[item['id']] = item
+    if shortcut_resolver:
+        shortcut_resolver.notify(item['id'], dest_id)
+
+def record_copy(item, copied_file):
+    """Record in src2dest that item was copied to copied_file."""
+    global nfile_count
+    record_dest(item, copied_file['id'])
+    nfile_count += 1
+
+class CopyPipeline:
+    """
+    Copies files on a pool of worker threads while copy_folder keeps walking the source.
+
+    copy_folder still lists folders and creates destination folders in order on the calling thread, so a
+    folder always exists before any file is copied into it.  Each file is handed to submit(), which blocks
+    while max_inflight copies are already running.  A worker of service_pool copies the file, its comments
+    and its modifiedTime using that thread's own Drive service, since a service is not thread safe.
+    Finished copies are recorded in src2dest on the calling thread, so the bookkeeping is never shared
+    between threads.  A failed copy is logged and leaves dest_id as None so that a rerun copies it again.
+    """
+    def __init__(self, max_inflight=8, service_pool=None):
+        self.service_pool = service_pool or ServicePool(max_inflight)
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.inflight = []  # (item, future, on_done) for copies not yet recorded
+        self.failed = 0
+
+    def submit(self, item, dest_folder_id, drive_id=None, on_done=None):
+        """Queue a copy of item; on_done(copied_file) is called on the calling thread once it is recorded."""
+        self.slots.acquire()
+        future = self.service_pool.submit(copy_file_with_metadata, item, dest_folder_id, drive_id)
+        # released however the future ends, including when the worker could not get a service
+        future.add_done_callback(lambda future: self.slots.release())
+        self.inflight.append((item, future, on_done))
+        self.collect()
+
+    def collect(self, wait=False):
+        """Record the copies that have finished; with wait, wait for all of them first."""
+        pending = []
+        for item, future, on_done in self.inflight:
+            if not wait and not future.done():
+                pending.append((item, future, on_done))
                 continue
-            new_shortcut = {
-                'name': shortcut_name,
-                'mimeType': 'application/vnd.google-apps.shortcut',
-                'shortcutDetails': {
-                    'targetId': new_target_id
-                },
-                'parents': [dest_folder_id]
-            }
-            if DRY_RUN:
+            try:
+                copied_file = future.result()
+            except Exception as error:
+                self.failed += 1
+                logger.error(f"Copy failed: {item['name']} (ID: {item['id']}) {error}")
+                post_logger.error(f"Copy failed: {item['name']} (ID: {item['id']}) {error}")
                 continue
-            copied_shortcut = retry_request(drive_service.files().create, body=new_shortcut, supportsAllDrives=True, fields='id')
-            post_logger.info(f"Copied shortcut: {shortcut_name} {oldtarget_id} to {new_target_id} {copied_shortcut}")
-        else:
-            logger.error(f"Fix Shortcut: {shortcut_name} {shortcut_id} target {oldtarget_id} not found in src2dest map.")
-            post_logger.error(f"Fix Shortcut: {shortcut_name} {shortcut_id} target {oldtarget_id} not found in src2dest map.")
+            if copied_file:
+                record_copy(item, copied_file)
+                if on_done:
+                    on_done(copied_file)
+        self.inflight = pending
 
-def copy_folder(drive_service, docs_service, sheets_service, slides_service, src_folder_id, dest_folder_id, drive_id=None):
-    """Recursively copy a folder and its contents."""
-    global tfile_count,nfile_count,tfolder_count,nfolder_count
+    def close(self):
+        try:
+            self.collect(wait=True)
+        finally:
+            self.service_pool.close()
 
-    # Get all items in the destination folder once
-    existing_items = list_files(drive_service, dest_folder_id, drive_id)
-    existing_files = {k_nmt(item): item for item in existing_items if item['mimeType'] != 'application/vnd.google-apps.folder' and item['trashed'] == False }
-    existing_folders = {item['name']: item for item in existing_items if item['mimeType'] == 'application/vnd.google-apps.folder' and item['trashed'] == False }
+def copy_folder(drive_service, docs_service, sheets_service, slides_service, src_folder_id, dest_folder_id, drive_id=None, max_inflight=None, pipeline=None):
+    """
+    Recursively copy a folder and its contents.
+    When max_inflight is set, up to that many files are copied at once using a CopyPipeline.
+    """
+    global tfile_count,nfile_count,tfolder_count,nfolder_count
+    if max_inflight and pipeline is None:
+        pipeline = CopyPipeline(max_inflight)
+        try:
+            copy_folder(drive_service, docs_service, sheets_service, slides_service, src_folder_id, dest_folder_id, drive_id, pipeline=pipeline)
+        finally:
+            # copies that finished before an error are recorded, so a rerun does not copy them again
+            pipeline.close()
+        return
+
+    # Get all items in the destination folder once, indexing each page as it arrives.  Pages are fetched
+    # inline: the pipeline's workers are kept busy with copies, so a prefetch through them would wait behind those
+    existing_items = []
+    existing_files = {}
+    existing_folders = {}
+    for item in iter_files(drive_service, dest_folder_id, drive_id, profile='copy', include_trashed=True):
+        existing_items.append(item)
+        if item['trashed'] == False:
+            if item['mimeType'] == 'application/vnd.google-apps.folder':
+                existing_folders[item['name']] = item
+            else:
+                existing_files[k_nmt(item)] = item
     
     # Get all items in the source folder
     items = list_files(drive_service, src_folder_id, drive_id)
@@ -332,8 +579,7 @@ def copy_folder(drive_service, docs_service, sheets_service, slides_service, src
 
     for item in items:
     
-        src2dest[item['id']] = item
-        src2dest[item['id']]['dest_id'] = None
+        record_dest(item, shortcut_dest(item))
 
         if item['name'] == 'Copy of NUUC Congregational Vote 2020-04-19':
             print(f"Found It: {item}")
@@ -342,7 +588,7 @@ def copy_folder(drive_service, docs_service, sheets_service, slides_service, src
             srcname = item['name']
             if srcname in existing_folders:
                 created_folder_id = existing_folders[srcname]['id']
-                src2dest[item['id']]['dest_id'] = created_folder_id 
+                record_dest(item, created_folder_id)
 
                 logger.info(f"Folder {srcname} exists. use exiting ID: {created_folder_id}")
             else:
@@ -358,22 +604,20 @@ def copy_folder(drive_service, docs_service, sheets_service, slides_service, src
                 created_folder_id = created_folder['id']
                 logger.info(f"Created folder: {item['name']} (ID: {created_folder_id})")
                 existing_folders[srcname] = created_folder  # Add the new folder to the existing folders map
-                src2dest[item['id']]['dest_id'] = created_folder_id 
+                record_dest(item, created_folder_id)
                 nfolder_count += 1
 
             # Recursively copy the contents of the folder
-            copy_folder(drive_service, docs_service, sheets_service, slides_service, item['id'], created_folder_id, drive_id)
+            copy_folder(drive_service, docs_service, sheets_service, slides_service, item['id'], created_folder_id, drive_id, pipeline=pipeline)
         else:
             tfile_count += 1
             if item['mimeType'] == 'application/vnd.google-apps.shortcut':
-                shortcut2target_folder.append( [item['id'], dest_folder_id])
-                post_logger.info(f"Shortcut: {item}")
-                src2dest[item['id']]['dest_id'] = None
+                queue_shortcut(item, dest_folder_id)
                 continue
 
             if k_nmt(item) in existing_files:
                 logger.info(f"File exists {k_nmt(item)} src ID {item['id']} in folder {dest_folder_id}. Skipping.")
-                src2dest[item['id']]['dest_id'] = existing_files[k_nmt(item)]['id']
+                record_dest(item, existing_files[k_nmt(item)]['id'])
                 continue
 
             logger.info(f"Copying file: {item['name']} (ID: {item['id']})")
@@ -384,137 +628,532 @@ def copy_folder(drive_service, docs_service, sheets_service, slides_service, src
             # continue unless item['name'] starts with '2020-08-01 Music Director Contract'
             if not item['name'].startswith('2020-08-01 Music Director Contract'):
                 pass
+            if pipeline:
+                # copied on a worker thread, src2dest is updated when the copy finishes
+                pipeline.submit(item, dest_folder_id, drive_id)
+                continue
             copied_file = {}
-            copied_file = copy_file(drive_service, item['id'], dest_folder_id, item, drive_id)
+            copied_file = copy_file_with_metadata(drive_service, item, dest_folder_id, drive_id)
             if copied_file:
-                src2dest[item['id']]['dest_id'] = copied_file['id']
-                nfile_count += 1
-                logger.info(f"Copied file: {item['name']} (ID: {copied_file['id']})")
-                post_logger.info(f"Copied: {item['name']} {copied_file}")
-
-                # Copy the comments if this mime type supports comments.
-                if item['mimeType'] in [
-                        "application/vnd.google-apps.document",
-                        "application/vnd.google-apps.spreadsheet",
-                        "application/vnd.google-apps.presentation",
-                        "application/vnd.google-apps.drawing"
-                    ]:
-                    copy_comments(drive_service, item['id'], copied_file['id'])
-                    # updating the modified time after copying comments may not work if applied right away.
-                    # probably should collect these ids for later processing.  At least this copy in 
-                    # the post_logger data will be relatively easy to turn into a list of ids to process.
-                    # discovered this while copying the board folder.  The modifiedTime was not updated on many
-                    # files that had comments
-                    post_logger.warning(f"Copied comments: modifiedTime may be wrong {copied_file['id']}")
-
-                # Update modified time after copying comments if they exist
-                update_file = {}
-                if 'modifiedTime' in item:
-                    update_file['modifiedTime'] = item['modifiedTime']
-                if update_file:
-                    update = retry_request(drive_service.files().update, fileId=copied_file['id'], body=update_file, fields='id, modifiedTime', supportsAllDrives=True)
-                    post_logger.warning(f"Updated: {item['name']} {update_file} {update}")
+                record_copy(item, copied_file)
                 # Add the new file to the existing files map
                 existing_files[k_nmt(item)] = copied_file
     logger.info(f"Folder {src_folder_id} copied to {dest_folder_id} - folders={nfolder_count}/{tfolder_count} files={nfile_count}/{tfile_count}.")
 
 
+#################################################################################
+# Two phase copy.  plan_copy() walks the source and destination once and returns a plan, a list of
+# operations that can be saved as json, reviewed and estimated before anything is changed.  execute_plan()
+# then carries the operations out, marking each one done so that a rerun picks up where it stopped
+# without listing anything again.
+#
+# Each operation is a dict with 'op', the source 'item' and 'parent', the id of the source folder holding it:
+#   create_folder - create a folder named item['name'] in the destination of parent
+#   copy_file     - copy the file into the destination of parent
+#   shortcut      - queue the shortcut for the ShortcutResolver, which needs the target to be copied first
+#   skip          - item already exists in the destination as 'dest_id'
+# plan['folders'] maps source folder ids to destination folder ids.  It starts with the folders that already
+# exist and execute_plan adds each folder it creates.
+
+def plan_copy(drive_service, src_folder_id, dest_folder_id, drive_id=None):
+    """Walk the source and destination folders and return the plan for copying one into the other."""
+    plan = {'src_folder_id': src_folder_id, 'dest_folder_id': dest_folder_id, 'drive_id': drive_id,
+            'planned': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+            'folders': {src_folder_id: dest_folder_id}, 'ops': []}
+    plan_folder(drive_service, plan, src_folder_id, dest_folder_id, drive_id)
+    return plan
+
+def plan_folder(drive_service, plan, src_folder_id, dest_folder_id, drive_id=None):
+    """Add the operations for copying src_folder_id to the plan.  dest_folder_id is None when it is still to be created."""
+    ops = plan['ops']
+
+    # a folder that is still to be created is empty, so there is nothing to list
+    existing_items = list_files(drive_service, dest_folder_id, drive_id) if dest_folder_id else []
+    existing_files = {k_nmt(item): item for item in existing_items if item['mimeType'] != 'application/vnd.google-apps.folder' and item['trashed'] == False }
+    existing_folders = {item['name']: item for item in existing_items if item['mimeType'] == 'application/vnd.google-apps.folder' and item['trashed'] == False }
+
+    items = list_files(drive_service, src_folder_id, drive_id)
+    rename_duplicates(items)
+    if dest_folder_id:
+        diff_folders(items, existing_items) # log the differences between the source and destination folders
+
+    for item in items:
+        op = {'item': item, 'parent': src_folder_id}
+        if item['mimeType'] == 'application/vnd.google-apps.folder':
+            if item['name'] in existing_folders:
+                op.update(op='skip', dest_id=existing_folders[item['name']]['id'])
+                plan['folders'][item['id']] = op['dest_id']
+            else:
+                op['op'] = 'create_folder'
+            ops.append(op)
+            plan_folder(drive_service, plan, item['id'], op.get('dest_id'), drive_id)
+        elif item['mimeType'] == 'application/vnd.google-apps.shortcut':
+            op['op'] = 'shortcut'
+            ops.append(op)
+        elif k_nmt(item) in existing_files:
+            op.update(op='skip', dest_id=existing_files[k_nmt(item)]['id'])
+            ops.append(op)
+        else:
+            op['op'] = 'copy_file'
+            ops.append(op)
+
+def plan_summary(plan):
+    """Return a one line description of the work remaining in the plan."""
+    remaining = [op for op in plan['ops'] if not op.get('done')]
+    counts = {}
+    for op in remaining:
+        counts[op['op']] = counts.get(op['op'], 0) + 1
+    size = sum(int(op['item'].get('size', 0)) for op in remaining if op['op'] == 'copy_file')
+    return (f"Plan {plan['src_folder_id']} -> {plan['dest_folder_id']}: {len(remaining)}/{len(plan['ops'])} operations remaining "
+            f"{counts} {size / 1e6:.1f} MB to copy")
+
+def save_plan(plan, plan_file):
+    with open(plan_file + '.tmp', 'w') as f:
+        json.dump(plan, f)
+    os.replace(plan_file + '.tmp', plan_file)  # never leave a half written plan behind
+
+def load_plan(plan_file):
+    with open(plan_file, 'r') as f:
+        return json.load(f)
+
+def execute_plan(drive_service, plan, plan_file=None, max_inflight=None, service_pool=None, save_interval=30):
+    """
+    Carry out the operations of the plan that are not yet done, recording them in src2dest and
+    shortcut2target_folder.  Progress and an estimated time remaining are logged every 10 seconds, and the
+    plan is saved to plan_file every save_interval seconds and when execution ends, including by an error.
+    Operations whose item already has a dest_id in src2dest were done after the last save and are only
+    marked done.
+    When max_inflight is set, files are copied with a CopyPipeline, using service_pool if given.
+    """
+    global tfile_count, tfolder_count, nfolder_count
+    folders = plan['folders']
+    drive_id = plan['drive_id']
+    todo = [op for op in plan['ops'] if not op.get('done')]
+    pipeline = CopyPipeline(max_inflight, service_pool) if max_inflight else None
+    start = last_progress = last_save = time.time()
+    done = 0
+
+    def finish(op, dest_id=None):
+        nonlocal done
+        op['done'] = True
+        if dest_id:
+            op['dest_id'] = dest_id
+        done += 1
+
+    try:
+        for op in todo:
+            item = op['item']
+            copied = src2dest.get(item['id'])
+            if op['op'] in ('create_folder', 'copy_file') and copied and copied.get('dest_id'):
+                # done after the plan was last saved, src2dest is written as each copy finishes
+                if op['op'] == 'create_folder':
+                    folders[item['id']] = copied['dest_id']
+                finish(op, copied['dest_id'])
+                continue
+            record_dest(item, op.get('dest_id') or shortcut_dest(item))
+            if op['op'] == 'create_folder':
+                tfolder_count += 1
+                new_folder = {
+                    'name': item['name'],
+                    'mimeType': 'application/vnd.google-apps.folder',
+                    'parents': [folders[op['parent']]]
+                }
+                created_folder = retry_request(drive_service.files().create, body=new_folder, supportsAllDrives=True, fields='id')
+                logger.info(f"Created folder: {item['name']} (ID: {created_folder['id']})")
+                folders[item['id']] = created_folder['id']
+                record_dest(item, created_folder['id'])
+                nfolder_count += 1
+                finish(op, created_folder['id'])
+            elif op['op'] == 'copy_file':
+                tfile_count += 1
+                if pipeline:
+                    pipeline.submit(item, folders[op['parent']], drive_id, on_done=lambda copied_file, op=op: finish(op, copied_file['id']))
+                else:
+                    copied_file = copy_file_with_metadata(drive_service, item, folders[op['parent']], drive_id)
+                    if copied_file:
+                        record_copy(item, copied_file)
+                        finish(op, copied_file['id'])
+            elif op['op'] == 'shortcut':
+                tfile_count += 1
+                queue_shortcut(item, folders[op['parent']])
+                finish(op)
+            else:
+                finish(op)
+
+            now = time.time()
+            if now - last_progress > 10:
+                rate = done / (now - start)
+                eta = (len(todo) - done) / rate if rate else 0
+                logger.info(f"Plan: {done}/{len(todo)} operations done, {rate:.1f}/s, about {eta / 60:.0f} minutes remaining")
+                last_progress = now
+            if plan_file and now - last_save > save_interval:
+                save_plan(plan, plan_file)
+                last_save = now
+    finally:
+        if pipeline:
+            pipeline.close()
+        if plan_file:
+            save_plan(plan, plan_file)
+    logger.info(f"Plan executed in {time.time() - start:.0f}s: {plan_summary(plan)}")
+    if plan_file and all(op.get('done') for op in plan['ops']):
+        # retire the finished plan so that the next run plans again and picks up new source files
+        os.replace(plan_file, plan_file + '.done')
+
+def copy_with_plan(drive_service, src_folder_id, dest_folder_id, drive_id=None, plan_file='gdcopy_plan.json', max_inflight=None, service_pool=None):
+    """
+    Copy using the plan saved in plan_file, making and saving the plan first if there is none for these folders
+    or it is finished.  A plan that execute_plan finishes is renamed to plan_file + '.done'.
+    With DRY_RUN the plan is only made and saved.
+    """
+    plan = None
+    if os.path.exists(plan_file):
+        plan = load_plan(plan_file)
+        if (plan['src_folder_id'], plan['dest_folder_id']) != (src_folder_id, dest_folder_id):
+            logger.info(f"{plan_file} is for {plan['src_folder_id']} -> {plan['dest_folder_id']}, planning again")
+            plan = None
+        elif all(op.get('done') for op in plan['ops']):
+            logger.info(f"{plan_file} has nothing left to do, planning again")
+            plan = None
+    if plan is None:
+        plan = plan_copy(drive_service, src_folder_id, dest_folder_id, drive_id)
+        save_plan(plan, plan_file)
+    logger.info(plan_summary(plan))
+    post_logger.info(plan_summary(plan))
+    if DRY_RUN:
+        return plan
+    execute_plan(drive_service, plan, plan_file, max_inflight, service_pool)
+    return plan
+
+#################################################################################
+# Incremental sync.  copy_folder() matches source and destination by name, modifiedTime and mimeType, so a
+# renamed, moved or touched file is copied again in full and every destination folder is listed on every run.
+# sync_folder() instead starts from src2dest, which holds the source item as it was last copied along with
+# the id of its copy, and compares the source item now against that snapshot:
+#   unchanged - same name, parent and content: nothing to do, and no destination listing is needed
+#   renamed / moved / touched - same content: the copy is renamed, moved between folders or has its
+#               modifiedTime restored with a single files.update
+#   changed   - different content: copied again and the old copy trashed
+# Content is compared by md5Checksum and size for binary files, and by modifiedTime for Google files, which
+# have no checksum.  Items not in src2dest are adopted when an identical file is already in the destination
+# folder, which is only listed in that case, and copied otherwise.  Items deleted from the source are left
+# in the destination.
+
+class SyncStats:
+    """
+    What sync_folder() did.  bytes_saved and calls_saved are measured against copying afresh, which takes
+    a copy and a modifiedTime update per file and a listing per destination folder.
+    """
+    def __init__(self):
+        self.unchanged = 0
+        self.renamed = 0
+        self.moved = 0
+        self.touched = 0
+        self.adopted = 0
+        self.copied = 0
+        self.changed = 0
+        self.folders_created = 0
+        self.bytes_copied = 0
+        self.bytes_saved = 0
+        self.calls_saved = 0
+
+    def __str__(self):
+        return (f"Sync: {self.unchanged} unchanged, {self.renamed} renamed, {self.moved} moved, {self.touched} touched, "
+                f"{self.adopted} adopted, {self.changed} changed and copied again, {self.copied} copied, "
+                f"{self.folders_created} folders created; {self.bytes_copied} bytes copied, "
+                f"{self.bytes_saved} bytes and {self.calls_saved} calls saved")
+
+def same_content(item, previous):
+    """True when the source item has the same content as the snapshot previous."""
+    if item.get('md5Checksum') and previous.get('md5Checksum'):
+        return item['md5Checksum'] == previous['md5Checksum'] and item.get('size') == previous.get('size')
+    return item.get('modifiedTime') == previous.get('modifiedTime')
+
+def same_file(item, dest_item):
+    """True when dest_item, in the destination folder, can stand in for the source item."""
+    if item['mimeType'] != dest_item['mimeType'] or item['name'] != dest_item['name']:
+        return False
+    if item.get('md5Checksum') and dest_item.get('md5Checksum'):
+        return item['md5Checksum'] == dest_item['md5Checksum'] and item.get('size') == dest_item.get('size')
+    return item.get('modifiedTime') == dest_item.get('modifiedTime')
+
+def src_folder_of(item):
+    return (item.get('parents') or [None])[0]
+
+def sync_update(drive_service, item, previous, dest_folder_id, stats):
+    """
+    Bring the copy of item at previous['dest_id'] up to date with a single files.update: its name, its
+    folder and, for files, its modifiedTime.  Returns False if the copy no longer exists.
+    """
+    dest_id = previous['dest_id']
+    is_folder = item['mimeType'] == 'application/vnd.google-apps.folder'
+    body = {}
+    if item['name'] != previous.get('name'):
+        body['name'] = item['name']
+    if not is_folder and item.get('modifiedTime') != previous.get('modifiedTime'):
+        body['modifiedTime'] = item['modifiedTime']
+    old_parent = (previous.get('parents') or [None])[0]
+    moved = old_parent != src_folder_of(item)
+    if not body and not moved:
+        stats.unchanged += 1
+        if not is_folder:
+            stats.bytes_saved += int(item.get('size', 0))
+            stats.calls_saved += 2
+        return True
+
+    kwargs = {}
+    if moved:
+        # the copy is in the destination of the folder the source item used to be in
+        old_folder = src2dest.get(old_parent) if old_parent else None
+        old_dest_folder = old_folder.get('dest_id') if old_folder else None
+        if old_dest_folder is None:
+            copy = get_file(drive_service, dest_id)
+            old_dest_folder = ','.join(copy.get('parents', [])) if copy else None
+        kwargs = {'addParents': dest_folder_id, 'removeParents': old_dest_folder}
+    if 'modifiedTime' in body and not moved and 'name' not in body:
+        stats.touched += 1
+    if 'name' in body:
+        stats.renamed += 1
+    if moved:
+        stats.moved += 1
+    if not is_folder:
+        stats.bytes_saved += int(item.get('size', 0))
+        stats.calls_saved += 1
+    logger.info(f"Sync: update {item['name']} (ID: {item['id']}) copy {dest_id} {body} {kwargs}")
+    post_logger.info(f"Sync update: {item['name']} {dest_id} {body} {kwargs}")
+    if DRY_RUN:
+        return True
+    try:
+        retry_request(drive_service.files().update, fileId=dest_id, body=body, fields='id', supportsAllDrives=True, **kwargs)
+    except HttpError as error:
+        if error.resp.status == 404:
+            logger.info(f"Sync: copy {dest_id} of {item['name']} is gone, copying again")
+            return False
+        raise
+    return True
+
+def sync_folder(drive_service, src_folder_id, dest_folder_id, drive_id=None, stats=None):
+    """
+    Recursively bring dest_folder_id up to date with src_folder_id using src2dest, doing the least work
+    needed for each item.  Returns the SyncStats.  With DRY_RUN, folders that would be created are synced
+    with dest_folder_id None so that what would happen beneath them is reported too.
+    """
+    if stats is None:
+        stats = SyncStats()
+    items = list_files(drive_service, src_folder_id, drive_id)
+    rename_duplicates(items)
+
+    dest_items = None  # listed the first time an item has no copy recorded
+    def find_in_dest(item):
+        nonlocal dest_items
+        if dest_items is None:
+            dest_items = [d for d in list_files(drive_service, dest_folder_id, drive_id) if not d.get('trashed')] if dest_folder_id else []
+        for dest_item in dest_items:
+            if item['mimeType'] == 'application/vnd.google-apps.folder':
+                if dest_item['mimeType'] == item['mimeType'] and dest_item['name'] == item['name']:
+                    return dest_item
+            elif same_file(item, dest_item):
+                return dest_item
+        return None
+
+    for item in items:
+        is_folder = item['mimeType'] == 'application/vnd.google-apps.folder'
+        if item['mimeType'] == 'application/vnd.google-apps.shortcut':
+            if dest_folder_id is None:
+                logger.info(f"Sync: queue shortcut {item['name']} (ID: {item['id']}) in the new folder")
+                continue
+            record_dest(item, shortcut_dest(item))
+            queue_shortcut(item, dest_folder_id)
+            continue
+
+        previous = src2dest.get(item['id'])
+        previous = dict(previous) if previous and previous.get('dest_id') else None
+        stale_id = None
+        if previous and not is_folder and not same_content(item, previous):
+            # new content: copy again below, then trash the old copy
+            stale_id = previous['dest_id']
+            previous = None
+        elif previous and not sync_update(drive_service, item, previous, dest_folder_id, stats):
+            previous = None
+
+        if previous:
+            dest_id = previous['dest_id']
+        else:
+            dest_item = find_in_dest(item)
+            if dest_item:
+                dest_id = dest_item['id']
+                stats.adopted += 1
+                if not is_folder:
+                    stats.bytes_saved += int(item.get('size', 0))
+                    stats.calls_saved += 2
+                logger.info(f"Sync: adopt {dest_id} as the copy of {item['name']} (ID: {item['id']})")
+            elif is_folder:
+                stats.folders_created += 1
+                logger.info(f"Sync: create folder {item['name']} in {dest_folder_id}")
+                if DRY_RUN:
+                    sync_folder(drive_service, item['id'], None, drive_id, stats)
+                    continue
+                created = retry_request(drive_service.files().create, body={'name': item['name'], 'mimeType': item['mimeType'], 'parents': [dest_folder_id]}, supportsAllDrives=True, fields='id')
+                dest_id = created['id']
+            else:
+                if stale_id:
+                    stats.changed += 1
+                else:
+                    stats.copied += 1
+                stats.bytes_copied += int(item.get('size', 0))
+                logger.info(f"Sync: copy {item['name']} (ID: {item['id']}) to {dest_folder_id}")
+                if DRY_RUN:
+                    continue
+                copied_file = copy_file_with_metadata(drive_service, item, dest_folder_id, drive_id)
+                if not copied_file:
+                    continue
+                dest_id = copied_file['id']
+        if stale_id and stale_id != dest_id and not DRY_RUN:
+            retry_request(drive_service.files().update, fileId=stale_id, body={'trashed': True}, fields='id', supportsAllDrives=True)
+        record_dest(item, dest_id)
+
+        if is_folder:
+            sync_folder(drive_service, item['id'], dest_id, drive_id, stats)
+
+    if dest_items is None:
+        stats.calls_saved += 1  # the destination listing copy_folder would have made
+    return stats
+
+# for every itemm in src2dest, update the modifiedTime of the file specified by the dest_id
+COMMENT_MIME_TYPES = [
+    "application/vnd.google-apps.document",
+    "application/vnd.google-apps.spreadsheet",
+    "application/vnd.google-apps.presentation",
+    "application/vnd.google-apps.drawing"
+]
+
+def pending_modified_times(drive_service, files, drive_id=None):
+    """
+    Return the files, source items with a dest_id, whose copy's modifiedTime differs from the source.
+    The current modifiedTime of each copy is read from a listing of its destination folder, taken once per
+    folder.  A copy whose destination folder is not known from src2dest, or that is missing from the listing,
+    is read with batched files().get calls instead.
+    """
+    dest_times = {}     # dest id -> current modifiedTime
+    listed = set()
+    unlisted = []
+    for file in files:
+        parents = file.get('parents') or [None]
+        parent = src2dest.get(parents[0]) if parents[0] else None
+        dest_folder_id = parent.get('dest_id') if parent else None
+        if dest_folder_id and dest_folder_id not in listed:
+            listed.add(dest_folder_id)
+            for item in list_files(drive_service, dest_folder_id, drive_id):
+                dest_times[item['id']] = item.get('modifiedTime')
+        if file['dest_id'] not in dest_times:
+            unlisted.append(file['dest_id'])
+    requests = [(dest_id, drive_service.files().get(fileId=dest_id, fields='id, modifiedTime', supportsAllDrives=True))
+                for dest_id in unlisted]
+    for dest_id, (response, error) in batch_execute(drive_service, requests).items():
+        if error:
+            logger.error(f"Get modifiedTime: {dest_id} {error}")
+            post_logger.error(f"Get modifiedTime: {dest_id} {error}")
+        else:
+            dest_times[dest_id] = response.get('modifiedTime')
+    return [file for file in files if file['dest_id'] in dest_times and dest_times[file['dest_id']] != file['modifiedTime']]
+
+def update_modified_times(drive_service, files):
+    """
+    Set the modifiedTime of the copy of each source item in files to the source's, using batch requests.
+    Returns a dictionary of dest_id -> error for the updates that failed; the others are logged.
+    """
+    requests = [(file['dest_id'], drive_service.files().update(fileId=file['dest_id'], body={'modifiedTime': file['modifiedTime']},
+                                                               fields='id, modifiedTime', supportsAllDrives=True))
+                for file in files]
+    results = batch_execute(drive_service, requests)
+    errors = {}
+    for file in files:
+        update, error = results.get(file['dest_id'], (None, 'no response'))
+        if error:
+            errors[file['dest_id']] = error
+            logger.error(f"Update modifiedTime failed: {file['name']} {file['dest_id']} {error}")
+            post_logger.error(f"Update modifiedTime failed: {file['name']} {file['dest_id']} {error}")
+        else:
+            post_logger.warning(f"Updated: {file['name']} {{'modifiedTime': '{file['modifiedTime']}'}} {update}")
+    return errors
+
 # for every itemm in src2dest, update the modifiedTime of the file specified by the dest_id
-def fix_update_modified_time(drive_service):
+# when it differs from the source.  The updates are sent as batches of 100.
+def fix_update_modified_time(drive_service, drive_id=None):
+    files = []
     for src_id in src2dest:
-        if src2dest[src_id]['dest_id']:
-            file = src2dest[src_id]
-            # only update modified time for files that are capable of having comments
-            if file['mimeType'] in [
-                    "application/vnd.google-apps.document",
-                    "application/vnd.google-apps.spreadsheet",
-                    "application/vnd.google-apps.presentation",
-                    "application/vnd.google-apps.drawing"
-                ]:
-                update_file = {}
-                if 'modifiedTime' in file:
-                    update_file['modifiedTime'] = file['modifiedTime']
-                if update_file:
-                    update = retry_request(drive_service.files().update, fileId=file['dest_id'], body=update_file, fields='id, modifiedTime', supportsAllDrives=True)
-                    post_logger.warning(f"Updated: {file['name']} {update_file} {update}")
+        file = src2dest[src_id]
+        # only update modified time for files that are capable of having comments
+        if file['dest_id'] and file['mimeType'] in COMMENT_MIME_TYPES and 'modifiedTime' in file:
+            files.append(file)
+    pending = pending_modified_times(drive_service, files, drive_id)
+    logger.info(f"Update modifiedTime: {len(pending)} of {len(files)} copies differ from the source")
+    if pending and not DRY_RUN:
+        update_modified_times(drive_service, pending)
 
 # in messing with this, I suspected that copying comments was interfereing with updating the modifiedTime
 # so in the final Board run, I did not copy comments inline, but am doing it in this fix function and 
 # will update the modified time if needed.
 #
 # for every item in src2dest that is a mimetype that supports comments, copy the comments from the src file to the dest file
-def fix_copy_comments(drive_service):
+# then restore the modifiedTime of the files that had comments and whose copy's modifiedTime now differs, in batches.
+def fix_copy_comments(drive_service, drive_id=None):
+    commented = []
     for src_id in src2dest:
         file = src2dest[src_id]
-        if file['mimeType'] in [
-                "application/vnd.google-apps.document",
-                "application/vnd.google-apps.spreadsheet",
-                "application/vnd.google-apps.presentation",
-                "application/vnd.google-apps.drawing"
-            ]:
-            if copy_comments(drive_service, src_id, file['dest_id']):
-                # Update modified time after copying comments if they exist
-                update_file = {}
-                if 'modifiedTime' in file:
-                    update_file['modifiedTime'] = file['modifiedTime']
-                if update_file:
-                    update = retry_request(drive_service.files().update, fileId=file['dest_id'], body=update_file, fields='id, modifiedTime', supportsAllDrives=True)
-                    post_logger.info(f"Update modifiedTime: {file['name']} {update_file} {update}")
+        if file['dest_id'] and file['mimeType'] in COMMENT_MIME_TYPES:
+            if copy_comments(drive_service, src_id, file['dest_id']) and 'modifiedTime' in file:
+                commented.append(file)
+    # copy_comments counts the comments on the source, and on a rerun may have created none of them
+    pending = pending_modified_times(drive_service, commented, drive_id)
+    logger.info(f"Update modifiedTime: {len(pending)} of {len(commented)} commented copies differ from the source")
+    if pending:
+        update_modified_times(drive_service, pending)
 
 
 #################################################################################
 src2dest = {} # map source id to destination id
 shortcut2target_folder = [] # list of shortcuts and target parent folder id.  Will create a shortcut in the target folder after all processing is done
+state_store = None
 
-def load_state():
-    global src2dest, shortcut2target_folder
-    try:
-        with open('gdcopy_state.json', 'r') as f:
-            state = json.load(f)
-            src2dest = state.get('src2dest', {})
-            shortcut2target_folder = state.get('shortcuts_to_copy', [])
-    except FileNotFoundError:
-        src2dest = {}
-        shortcut2target_folder = []
-
-    # load an older state so we can merge in the changes from the current run.  So we start with the old state, and add in any of the current state values.
-    with open('gdcopy_state_old.json', 'r') as f:
-        state = json.load(f)
-        old_src2dest = state.get('src2dest', {})
-        old_shortcut2target_folder = state.get('shortcuts_to_copy', [])
-        for key in src2dest:
-            old_src2dest[key] = src2dest[key]
-        src2dest = old_src2dest
-
-        # to merge the shortcuts, we need to start with the old shortcuts, then any add it to the old shortcuts.  And any where the source id is already in the old shortcuts, we replace the old entry with the new entry.
-        for shortcut in shortcut2target_folder:
-            found = False
-            for i, old_shortcut in enumerate(old_shortcut2target_folder):
-                if shortcut[0] == old_shortcut[0]:
-                    old_shortcut2target_folder[i] = shortcut
-                    found = True
-                    break
-            if not found:
-                old_shortcut2target_folder.append(shortcut)
-        shortcut2target_folder = old_shortcut2target_folder
-
+def load_state(path='gdcopy_state.db'):
+    """
+    Open the state store, creating it from gdcopy_state_old.json and then gdcopy_state.json the first time so
+    that the current state wins, and make src2dest and shortcut2target_folder views of it.
+    Every change made through record_dest() or shortcut2target_folder.append() is saved as it happens.
+    """
+    global src2dest, shortcut2target_folder, state_store
+    state_store = GDState.open_state(path)
+    src2dest = GDState.Src2Dest(state_store)
+    shortcut2target_folder = GDState.Shortcuts(state_store)
 
 def save_state():
-    state = {'src2dest': src2dest, 'shortcuts_to_copy': shortcut2target_folder}
-    with open('gdcopy_state.json', 'w') as f:
-        json.dump(state, f)
+    """Write back any src2dest entries changed in place; everything else is already saved."""
+    src2dest.flush()
 
-def copy_shared_folder(drive_service, docs_service, sheets_service, slides_service, src_folder_id, dest_folder_id, drive_id=None):
-    """Copy the shared folder to the destination folder."""
+def copy_shared_folder(drive_service, docs_service, sheets_service, slides_service, src_folder_id, dest_folder_id, drive_id=None, max_inflight=None, plan_file=None, sync=False):
+    """
+    Copy the shared folder to the destination folder, copying up to max_inflight files at once if set.
+    With plan_file the copy is planned first and executed from the plan, see copy_with_plan().
+    With sync an earlier copy is brought up to date incrementally, see sync_folder().
+    """
     # load the state information from 'gdcopy_state.json' into src2dest and shortcuts_to_copy
     # if the file does not exist, create it with an empty dictionary
     load_state()
+    # shortcuts are created as soon as their targets are copied, including ones queued by earlier runs
+    global shortcut_resolver
+    shortcut_resolver = ShortcutResolver(drive_service)
 
     #fix_copy_comments(drive_service)
     #fix_update_modified_time(drive_service)
 
     # Recursively copy the folder
-    #copy_folder(drive_service, docs_service, sheets_service, slides_service, src_folder_id, dest_folder_id, drive_id)
+    #copy_folder(drive_service, docs_service, sheets_service, slides_service, src_folder_id, dest_folder_id, drive_id, max_inflight)
+    if plan_file:
+        copy_with_plan(drive_service, src_folder_id, dest_folder_id, drive_id, plan_file, max_inflight)
+    if sync:
+        stats = sync_folder(drive_service, src_folder_id, dest_folder_id, drive_id)
+        logger.info(stats)
+        post_logger.info(stats)
 
     # fix the shortcuts
     try:
@@ -526,9 +1165,51 @@ def copy_shared_folder(drive_service, docs_service, sheets_service, slides_servi
     
     # save the state information to 'gdcopy_state.json'
     save_state()
+    logger.info(rate_limiter.report())
 
+def benchmark_copy(folders=20, files_per_folder=20, latency=0.05, max_inflight=(None, 4, 16, 32)):
+    """
+    Copy a synthetic folder tree on a FakeDrive that sleeps latency seconds per request, serially and then
+    with each max_inflight, and print the throughput.  Every fifth file is a document with a comment.
+    """
+    global src2dest, tfile_count, nfile_count, tfolder_count, nfolder_count
+    from FakeDrive import FakeDrive
+
+    logging.disable(logging.CRITICAL)   # keep the benchmark out of gdcopy.log and post_processing.log
+    try:
+        for inflight in max_inflight:
+            drive = FakeDrive(latency=latency)
+            drive_id = drive.add_drive('Bench')
+            src = drive.add_folder('Source', drive_id)
+            dest = drive.add_folder('Dest', drive_id)
+            for f in range(folders):
+                folder = drive.add_folder(f'folder{f}', src)
+                for i in range(files_per_folder):
+                    if i % 5:
+                        drive.add_file(f'file{i}.txt', folder, size=i)
+                    else:
+                        doc = drive.add_file(f'doc{i}', folder, mimeType='application/vnd.google-apps.document')
+                        drive.add_comment(doc, 'Looks good', replies=['Thanks'])
+            src2dest = {}
+            tfile_count = nfile_count = tfolder_count = nfolder_count = 0
+            calls = drive.total_calls()
+            start = time.time()
+            pipeline = CopyPipeline(inflight, ServicePool(inflight, factory=lambda: drive)) if inflight else None
+            copy_folder(drive, None, None, None, src, dest, drive_id, pipeline=pipeline)
+            if pipeline:
+                pipeline.close()
+            elapsed = time.time() - start
+            print(f"max_inflight={inflight}: copied {nfile_count} files in {elapsed:.1f}s, "
+                  f"{nfile_count / elapsed:.1f} files/s, {drive.total_calls() - calls} requests")
+    finally:
+        logging.disable(logging.NOTSET)
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['--bench-copy']:
+        # GDCopy.py --bench-copy [folders] [files_per_folder] [latency]
+        benchmark_copy(*[int(arg) for arg in sys.argv[2:4]], *[float(arg) for arg in sys.argv[4:5]])
+        sys.exit(0)
+
     drive_service, docs_service, sheets_service, slides_service = authenticate()
 
  #   list_files_in_folder(drive_service,  '0B6sDSIKItI3Tc2YwdTlhM3ItblU')
@@ -1,7 +1,16 @@
 import os
+import sys
 import pickle
 import logging
 import time
+import json
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
@@ -22,8 +31,8 @@ SCOPES = [
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def authenticate():
-    """Authenticate the user and return the drive, docs, sheets, and slides services."""
+def load_credentials():
+    """Return the user's credentials from token.pickle, refreshing them or signing in as needed."""
     creds = None
     if os.path.exists('token.pickle'):
         with open('token.pickle', 'rb') as token:
@@ -37,38 +46,194 @@ def authenticate():
             creds = flow.run_local_server(port=0)
         with open('token.pickle', 'wb') as token:
             pickle.dump(creds, token)
+    return creds
+
+def authenticate():
+    """Authenticate the user and return the drive, docs, sheets, and slides services."""
+    creds = load_credentials()
     drive_service = build('drive', 'v3', credentials=creds)
     docs_service = build('docs', 'v1', credentials=creds)
     sheets_service = build('sheets', 'v4', credentials=creds)
     slides_service = build('slides', 'v1', credentials=creds)
     return drive_service, docs_service, sheets_service, slides_service
 
+THROTTLE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RESOURCE_EXHAUSTED')
+RETRY_STATUSES = (500, 502, 503, 504)
+
+def error_reason(error):
+    """Return the reason Drive gives for an HttpError, e.g. 'rateLimitExceeded' or 'notFound', or None."""
+    try:
+        content = error.content.decode('utf-8') if isinstance(error.content, bytes) else error.content
+        details = json.loads(content)['error']
+        errors = details.get('errors') or [{}]
+        return errors[0].get('reason') or details.get('status')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread that talks to Drive, with jittered exponential backoff.
+
+    Each request takes a token before it is sent, and a caller waits when none are left.  Tokens refill
+    at `rate` per second up to `burst`.  When Drive reports rateLimitExceeded or userRateLimitExceeded, or
+    returns a 429, every caller is paused.  The pause lasts for the Retry-After time or a jittered backoff,
+    and the rate is halved.  The rate then climbs back towards max_rate as requests succeed.  A 5xx only
+    delays the caller that got it.  A real 403 or 404, or any other error, is raised at once.
+
+    The default of 200 requests a second matches Drive's default quota of 12,000 queries a minute.
+    """
+    def __init__(self, rate=200.0, burst=None, min_rate=1.0, max_retries=6, base_delay=1.0, max_delay=64.0):
+        self.max_rate = self.rate = rate
+        self.burst = burst or rate
+        self.min_rate = min_rate
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.requests = self.waits = self.retries = self.throttles = self.failures = 0
+        self.wait_time = self.throttled_time = 0.0
+
+    def acquire(self, cost=1):
+        """Take cost tokens, sleeping until they are available and any throttling pause has passed."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # reserve the tokens now, going into debt, so that waiting callers are served in order
+            self.tokens -= cost
+            delay = max(-self.tokens / self.rate, self.paused_until - now, 0)
+            self.requests += cost
+            if delay:
+                self.waits += 1
+                self.wait_time += delay
+        if delay:
+            time.sleep(delay)
+
+    def backoff(self, attempt, error=None):
+        """Seconds to wait before retry number attempt: Retry-After when Drive sends it, otherwise full jitter."""
+        retry_after = error.resp.get('retry-after') if error is not None and error.resp is not None else None
+        if retry_after and str(retry_after).isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def throttled(self, delay):
+        """Drive said we are going too fast: pause everyone for delay seconds and halve the rate."""
+        with self.lock:
+            now = time.monotonic()
+            self.throttles += 1
+            self.throttled_time += max(0, now + delay - max(self.paused_until, now))
+            self.paused_until = max(self.paused_until, now + delay)
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    @staticmethod
+    def is_throttle(error):
+        return error.resp.status == 429 or (error.resp.status == 403 and error_reason(error) in THROTTLE_REASONS)
+
+    def execute(self, request, cost=1):
+        """Execute an HttpRequest under the rate limit, retrying throttling and 5xx errors."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(cost)
+            try:
+                result = request.execute()
+            except HttpError as error:
+                throttle = self.is_throttle(error)
+                if not (throttle or error.resp.status in RETRY_STATUSES) or attempt == self.max_retries:
+                    with self.lock:
+                        self.failures += 1
+                    raise
+                delay = self.backoff(attempt, error)
+                with self.lock:
+                    self.retries += 1
+                logger.warning(f"Retrying in {delay:.1f}s after {error.resp.status} {error_reason(error)}: {error}")
+                if throttle:
+                    self.throttled(delay)
+                else:
+                    time.sleep(delay)
+                continue
+            self.succeeded()
+            return result
+
+    def report(self):
+        return (f"Rate limiter: {self.requests} requests, {self.waits} waits totalling {self.wait_time:.1f}s, "
+                f"{self.retries} retries, {self.throttles} throttled totalling {self.throttled_time:.1f}s, "
+                f"{self.failures} failed, rate now {self.rate:.1f}/s")
+
+# every Drive request made through GDService, GDCopy and DU-via-GD goes through this limiter
+rate_limiter = RateLimiter()
+
 def retry_request(func, *args, **kwargs):
-    """Retry a request in case of a transient error."""
-    max_retries = 5
-    for attempt in range(max_retries):
-        try:
-            if attempt:
-                time.sleep(3 ** attempt)  # Exponential backoff
-            return func(*args, **kwargs).execute()
-        except HttpError as error:
-            if error.resp.status in [403, 404, 500, 502, 503, 504]:
-                # get the current time in printable format
-                current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                logger.warning(f"*************************** Retrying due to {error.resp.status} {current_time}\n**** error: {error}")
-            else:
-                raise
-    logger.error(f"Max retries exceeded for request: {func.__name__}")
-    raise HttpError(f"Max retries exceeded for request: {func.__name__}")
-
-
-def get_metadata(service, file_id, additiona_fields=None):
-    """Get the metadata of a file."""
-
-    fields = (
-        "id, name, mimeType, parents, modifiedTime, createdTime, description, "
-        "starred, viewersCanCopyContent, writersCanShare, shortcutDetails, driveId"
-    )
+    """Execute func(*args, **kwargs) through rate_limiter, retrying throttling and transient errors."""
+    return rate_limiter.execute(func(*args, **kwargs))
+
+
+# Field masks for the files returned by list_files(), list_drive_files() and get_metadata(), named for what
+# the caller needs.  Drive returns, and the client parses, only the fields asked for, and asking for
+# permissions limits a listing to 100 files a page where the others get 1000, see page_size().
+#   minimal   - enough to walk a tree and tell files apart
+#   du-report - the columns of the DU-via-GD report, with the permission hints its PermissionResolver uses
+#   copy      - what GDCopy needs to copy and sync an item and restore its metadata
+#   audit     - du-report plus everything about how an item is shared
+PROFILES = {
+    'minimal': "id, name, mimeType, parents, modifiedTime",
+    'du-report': ("id, name, mimeType, parents, size, modifiedTime, driveId, "
+                  "owners(displayName, emailAddress), lastModifyingUser(displayName, emailAddress), "
+                  "permissions(id, role, type, emailAddress, domain), webViewLink, "
+                  "hasAugmentedPermissions, inheritedPermissionsDisabled"),
+    'copy': ("id, name, mimeType, parents, size, md5Checksum, modifiedTime, createdTime, description, starred, "
+             "viewersCanCopyContent, writersCanShare, trashed, shortcutDetails, driveId"),
+    'audit': ("id, name, mimeType, parents, size, modifiedTime, createdTime, driveId, "
+              "owners(displayName, emailAddress), lastModifyingUser(displayName, emailAddress), "
+              "permissions(id, role, type, emailAddress, domain, allowFileDiscovery, expirationTime, deleted, permissionDetails), "
+              "webViewLink, hasAugmentedPermissions, inheritedPermissionsDisabled, shared, "
+              "sharingUser(displayName, emailAddress), writersCanShare, viewersCanCopyContent, copyRequiresWriterPermission"),
+}
+
+def split_fields(fields):
+    """Split a field mask into its top level fields, e.g. "id, owners(displayName, emailAddress)" into two."""
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(fields):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(fields[start:i].strip())
+            start = i + 1
+    parts.append(fields[start:].strip())
+    return [part for part in parts if part]
+
+def profile_fields(profile, additional_fields=None, exclude=()):
+    """The field mask of profile with additional_fields appended, leaving out repeats and the top level fields in exclude."""
+    fields = []
+    for field in split_fields(PROFILES[profile]) + split_fields(additional_fields or ''):
+        if field not in fields and field.split('(')[0].strip() not in exclude:
+            fields.append(field)
+    return ', '.join(fields)
+
+def page_size(fields):
+    """The largest pageSize Drive honours for a listing of fields: 100 if it includes permissions, otherwise 1000."""
+    return 100 if 'permissions' in [field.split('(')[0].strip() for field in split_fields(fields)] else 1000
+
+def get_metadata(service, file_id, additiona_fields=None, profile=None):
+    """Get the metadata of a file, with the fields of profile if given."""
+
+    if profile:
+        fields = profile_fields(profile)
+    else:
+        fields = (
+            "id, name, mimeType, parents, modifiedTime, createdTime, description, "
+            "starred, viewersCanCopyContent, writersCanShare, shortcutDetails, driveId"
+        )
     if additiona_fields:
         fields += f", {additiona_fields}"
     
@@ -79,16 +244,22 @@ def get_metadata(service, file_id, additiona_fields=None):
     return metadata
 
 
-def list_files(service, folder_id, drive_id=None, additional_fields=None):
+def list_files_fields(additional_fields=None, profile='du-report'):
+    """Return the per file field list used by list_files(), the fields of profile with any additional fields appended."""
+    return profile_fields(profile, additional_fields)
+
+def list_files(service, folder_id, drive_id=None, additional_fields=None, profile='du-report'):
     """
     List all non-trashed files within a specified Google Drive folder, with support for shared drives and pagination.
-    Allows for specifying additional fields to retrieve for each file.
+    Each file has the fields of profile, one of PROFILES, plus any additional fields, and each request asks
+    for as many files as Drive will return for those fields.
 
     Args:
         service (googleapiclient.discovery.Resource): The Google Drive service object, authenticated via the Google API client library.
         folder_id (str): The ID of the folder to list contents from.
         drive_id (str, optional): The ID of the shared drive (if applicable). If provided, the function searches in this shared drive;
                                   otherwise, it defaults to the user's My Drive.
+        profile (str, optional): The PROFILES entry naming the base fields, 'du-report' by default.
         additional_fields (str, optional): Comma-separated string of additional file metadata fields to retrieve.
                                            Possible fields include:
                                            - `id`: Unique identifier of the file.
@@ -123,38 +294,85 @@ def list_files(service, folder_id, drive_id=None, additional_fields=None):
         for file in files:
             print(f"Name: {file['name']}, Size: {file.get('size', 'N/A')}, View Link: {file.get('webViewLink', 'N/A')}")
     """
-    # Define the default fields to retrieve
-    base_fields = (
-        "id, name, mimeType, parents, size, modifiedTime, driveId,"
-        "permissions(id, role, type, emailAddress, domain), "
-        "owners, lastModifyingUser(displayName, emailAddress)"
+    return list(iter_files(service, folder_id, drive_id, additional_fields, profile))
+
+def iter_files(service, folder_id, drive_id=None, additional_fields=None, profile='du-report', pool=None, include_trashed=False):
+    """
+    Yield the files of list_files() one at a time as each page of the listing arrives, so a caller can
+    start on the first page before the last has been fetched and never holds a huge folder in memory.
+
+    With pool, a ServicePool, the request for the next page is sent from one of its workers as soon as
+    its page token is known, so it is on its way while the caller works through the current page.  Do
+    not pass the pool whose worker is running the caller, as a busy pool would then wait on itself.
+    include_trashed lists trashed files too.
+    """
+    file_fields = list_files_fields(additional_fields, profile)
+    query = f"'{folder_id}' in parents" if include_trashed else f"'{folder_id}' in parents and trashed = false"
+    request = dict(
+        q=query,
+        spaces='drive',
+        corpora='drive' if drive_id else 'user',
+        driveId=drive_id,
+        includeItemsFromAllDrives=True,
+        supportsAllDrives=True,
+        pageSize=page_size(file_fields),
+        fields=f"nextPageToken, files({file_fields})",
     )
-    
-    # Append any additional fields specified by the user
-    fields = f"nextPageToken, files({base_fields}"
-    if additional_fields:
-        fields += f", {additional_fields}"
-    fields += ")"
-    
-    query = f"'{folder_id}' in parents and trashed = false"
+
+    def fetch(service, page_token):
+        return rate_limiter.execute(service.files().list(pageToken=page_token, **request))
+
+    results = fetch(service, None)
+    while True:
+        page_token = results.get('nextPageToken', None)
+        next_page = pool.submit(fetch, page_token) if pool and page_token else None
+        try:
+            yield from results.get('files', [])
+        except GeneratorExit:
+            # the caller stopped early, the next page is not wanted
+            if next_page:
+                next_page.cancel()
+            raise
+        if page_token is None:
+            return
+        results = next_page.result() if next_page else fetch(service, page_token)
+
+def list_drive_files(service, drive_id, additional_fields=None, profile='du-report'):
+    """
+    List every non-trashed item in a shared drive as a single flat, paginated query.
+
+    Walking a shared drive with list_files() costs at least one request per folder.  This instead
+    issues one corpora='drive' listing of the whole drive with pageSize=1000, so a drive with 40k
+    folders and 200k files takes a few hundred requests.  `parents` is always included so callers
+    can rebuild the folder tree in memory, see build_children_map().
+
+    Args:
+        service (googleapiclient.discovery.Resource): The Google Drive service object.
+        drive_id (str): The ID of the shared drive to list.
+        additional_fields (str, optional): Comma-separated string of additional file metadata fields to retrieve.
+        profile (str, optional): The PROFILES entry naming the base fields.  `permissions` is always left out, as it
+                                 is not populated for shared drive items and requesting it caps the page size at 100.
+
+    Returns:
+        list of dict: A list of dictionaries, one per non-trashed item in the drive.
+    """
+    fields = f"nextPageToken, files({profile_fields(profile, additional_fields, exclude=('permissions',))})"
+
     items = []
     page_token = None
     while True:
-        if drive_id:
-            corpora = 'drive'
-        else:
-            corpora = 'user'
-        results = service.files().list(
-            q=query,
+        results = rate_limiter.execute(service.files().list(
+            q="trashed = false",
             spaces='drive',
-            corpora=corpora,
+            corpora='drive',
             driveId=drive_id,
             includeItemsFromAllDrives=True,
             supportsAllDrives=True,
+            pageSize=1000,
             fields=fields,
             pageToken=page_token
-        ).execute()
-        
+        ))
+
         items.extend(results.get('files', []))
         page_token = results.get('nextPageToken', None)
         if page_token is None:
@@ -162,6 +380,139 @@ def list_files(service, folder_id, drive_id=None, additional_fields=None):
 
     return items
 
+def build_children_map(items):
+    """Given a flat list of items with `parents`, return a dictionary mapping each parent id to its list of children."""
+    children = {}
+    for item in items:
+        for parent_id in item.get('parents', []):
+            children.setdefault(parent_id, []).append(item)
+    return children
+
+class MetadataCache:
+    """
+    Persistent on-disk cache of list_files() results, kept current from the Drive changes feed.
+
+    Folder listings and the metadata of every listed item are stored in SQLite keyed by file id.
+    A changes feed start page token is stored per corpus ('user', or the shared drive id), taken before
+    the first listing so nothing is missed.  The first list_files() call of a session replays the
+    changes since that token into the cache, so a repeat walk only fetches the deltas and folder
+    listings that were never cached.
+
+    The changes feed does not report items whose only change is a permission inherited from a
+    parent folder, so the `permissions` of cached items can lag behind a sharing change made on an
+    ancestor.  Delete the cache file to force a full refresh.
+
+    Example:
+        cache = MetadataCache('gd_metadata_cache.db')
+        files = cache.list_files(drive_service, folder_id, additional_fields="webViewLink")
+    """
+    def __init__(self, path='gd_metadata_cache.db'):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS item_parents (parent TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (parent, id));
+            CREATE INDEX IF NOT EXISTS item_parents_id ON item_parents (id);
+            CREATE TABLE IF NOT EXISTS listed (folder_id TEXT PRIMARY KEY, fields TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS tokens (corpus TEXT PRIMARY KEY, token TEXT NOT NULL);
+        """)
+        self.refreshed = set()  # corpora brought up to date from the changes feed in this session
+        self.hits = 0
+        self.misses = 0
+        self.changes_applied = 0
+
+    def list_files(self, service, folder_id, drive_id=None, additional_fields=None, profile='du-report'):
+        """Same as list_files(), answered from the cache when the folder has been listed with the same fields."""
+        fields = list_files_fields(additional_fields, profile)
+        with self.lock:
+            self._refresh(service, drive_id, fields)
+            row = self.conn.execute("SELECT fields FROM listed WHERE folder_id = ?", (folder_id,)).fetchone()
+            if row and row[0] == fields:
+                self.hits += 1
+                return [json.loads(data) for (data,) in self.conn.execute(
+                    "SELECT items.data FROM item_parents JOIN items ON items.id = item_parents.id "
+                    "WHERE item_parents.parent = ?", (folder_id,))]
+        self.misses += 1
+        items = list_files(service, folder_id, drive_id, additional_fields, profile)
+        with self.lock:
+            self.conn.execute("DELETE FROM item_parents WHERE parent = ?", (folder_id,))
+            for item in items:
+                self._store(item)
+            self.conn.execute("INSERT OR REPLACE INTO listed (folder_id, fields) VALUES (?, ?)", (folder_id, fields))
+            self.conn.commit()
+        return items
+
+    def _store(self, item):
+        self.conn.execute("INSERT OR REPLACE INTO items (id, data) VALUES (?, ?)", (item['id'], json.dumps(item)))
+        self.conn.execute("DELETE FROM item_parents WHERE id = ?", (item['id'],))
+        self.conn.executemany("INSERT OR IGNORE INTO item_parents (parent, id) VALUES (?, ?)",
+                              [(parent, item['id']) for parent in item.get('parents', [])])
+
+    def _forget(self, file_id):
+        self.conn.execute("DELETE FROM items WHERE id = ?", (file_id,))
+        self.conn.execute("DELETE FROM item_parents WHERE id = ?", (file_id,))
+
+    def _is_known(self, file_id, parents):
+        """True when the changed item is in the cache, or belongs in a folder listing held by the cache."""
+        if self.conn.execute("SELECT 1 FROM items WHERE id = ?", (file_id,)).fetchone():
+            return True
+        return any(self.conn.execute("SELECT 1 FROM listed WHERE folder_id = ?", (parent,)).fetchone()
+                   for parent in parents)
+
+    def _refresh(self, service, drive_id, fields):
+        """Once per session and corpus, apply the changes feed since the stored start page token."""
+        corpus = drive_id or 'user'
+        if corpus in self.refreshed:
+            return
+        self.refreshed.add(corpus)
+        row = self.conn.execute("SELECT token FROM tokens WHERE corpus = ?", (corpus,)).fetchone()
+        if not row:
+            # nothing cached for this corpus yet, start tracking changes from now
+            token = rate_limiter.execute(service.changes().getStartPageToken(driveId=drive_id, supportsAllDrives=True))['startPageToken']
+            self.conn.execute("INSERT OR REPLACE INTO tokens (corpus, token) VALUES (?, ?)", (corpus, token))
+            self.conn.commit()
+            return
+
+        page_token = row[0]
+        try:
+            while page_token:
+                results = rate_limiter.execute(service.changes().list(
+                    pageToken=page_token,
+                    driveId=drive_id,
+                    spaces='drive',
+                    includeItemsFromAllDrives=True,
+                    supportsAllDrives=True,
+                    pageSize=1000,
+                    fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({fields}, trashed))"
+                ))
+                for change in results.get('changes', []):
+                    file = change.get('file') or {}
+                    if change.get('removed') or file.get('trashed'):
+                        self._forget(change['fileId'])
+                    elif self._is_known(change['fileId'], file.get('parents', [])):
+                        file.pop('trashed', None)
+                        self._store(file)
+                    self.changes_applied += 1
+                page_token = results.get('nextPageToken')
+                if results.get('newStartPageToken'):
+                    self.conn.execute("UPDATE tokens SET token = ? WHERE corpus = ?", (results['newStartPageToken'], corpus))
+                self.conn.commit()
+        except HttpError as error:
+            # an expired or invalid token means the cache can no longer be trusted
+            logger.warning(f"Changes feed failed for {corpus}, clearing the metadata cache: {error}")
+            self.clear()
+            self.refreshed.discard(corpus)
+            self._refresh(service, drive_id, fields)
+
+    def clear(self):
+        with self.lock:
+            self.conn.executescript("DELETE FROM items; DELETE FROM item_parents; DELETE FROM listed; DELETE FROM tokens;")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
 # list_permissions
 # https://chatgpt.com/c/67200022-8040-8002-a988-4daa590ce489
 
@@ -192,11 +543,11 @@ def get_permissions(service, file_id):
             print(f"Role: {perm['role']}, Type: {perm['type']}, Email: {perm.get('emailAddress', 'N/A')}")
     """
     try:
-        permissions = service.permissions().list(
+        permissions = rate_limiter.execute(service.permissions().list(
             fileId=file_id,
             supportsAllDrives=True,
             fields="permissions(id, role, type, emailAddress, domain, allowFileDiscovery)"
-        ).execute().get('permissions', [])
+        )).get('permissions', [])
         return permissions
     except Exception as e:
         print(f"An error occurred while retrieving permissions: {e}")
@@ -233,11 +584,11 @@ def get_permission_details(service, file_id):
             print(f"Role: {perm['role']}, Type: {perm['type']}, Inherited: {perm['permissionDetails'][0].get('inherited')}")
     """
     try:
-        permissions = service.permissions().list(
+        permissions = rate_limiter.execute(service.permissions().list(
             fileId=file_id,
             supportsAllDrives=True,
             fields="permissions(id, role, type, emailAddress, domain, allowFileDiscovery, permissionDetails)"
-        ).execute().get('permissions', [])
+        )).get('permissions', [])
         return permissions
     except Exception as e:
         print(f"An error occurred while retrieving permission details: {e}")
@@ -257,6 +608,170 @@ def get_permission_details(service, file_id):
         #     'emailAddress': 'minister@northlakeuu.org',
         #     'role': 'fileOrganizer'
         # }
+def batch_execute(service, requests, batch_size=100):
+    """
+    Execute many Drive API requests as batch HTTP requests of up to batch_size calls each.
+
+    Args:
+        service (googleapiclient.discovery.Resource): The authenticated Google Drive service instance.
+        requests (list of (key, HttpRequest)): The requests to run, each paired with a caller chosen key.
+        batch_size (int): Calls per batch, Drive allows at most 100.
+
+    Returns:
+        dict: key -> (response, exception).  Exactly one of the two is None for each key, so per item
+              failures can be handled by the caller without losing the rest of the batch.
+
+    Each call in a batch counts against the quota, so a batch takes one rate_limiter token per call, and
+    a throttled call inside a batch throttles the limiter just as a throttled single request does.  Calls
+    that were throttled or got a 5xx are batched again after the backoff, up to rate_limiter.max_retries
+    times as RateLimiter.execute() does for single requests, so only permanent errors are returned.
+    """
+    results = {}
+    for attempt in range(rate_limiter.max_retries + 1):
+        retry = []
+        throttled = False
+        for start in range(0, len(requests), batch_size):
+            chunk = requests[start:start + batch_size]
+
+            def callback(request_id, response, exception, chunk=chunk):
+                results[chunk[int(request_id)][0]] = (response, exception)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for index, (key, request) in enumerate(chunk):
+                batch.add(request, request_id=str(index))
+            rate_limiter.execute(batch, cost=len(chunk))
+            failed = [(key, request) for key, request in chunk
+                      if key in results and isinstance(results[key][1], HttpError)
+                      and (RateLimiter.is_throttle(results[key][1]) or results[key][1].resp.status in RETRY_STATUSES)]
+            throttles = [results[key][1] for key, _ in failed if RateLimiter.is_throttle(results[key][1])]
+            if throttles:
+                # pauses the next batch, including the retries, for everyone
+                rate_limiter.throttled(rate_limiter.backoff(attempt, throttles[0]))
+                throttled = True
+            retry += failed
+        if not retry:
+            break
+        error = results[retry[0][0]][1]
+        with rate_limiter.lock:
+            if attempt == rate_limiter.max_retries:
+                rate_limiter.failures += len(retry)
+                break
+            rate_limiter.retries += len(retry)
+        logger.warning(f"Retrying {len(retry)} batched calls after {error.resp.status} {error_reason(error)}: {error}")
+        if not throttled:
+            time.sleep(rate_limiter.backoff(attempt, error))
+        requests = retry
+    return results
+
+def get_permission_details_batch(service, file_ids):
+    """
+    Retrieve detailed permissions, as returned by get_permission_details(), for many files using batch requests.
+    A file whose batched call fails is retried on its own with get_permission_details().
+
+    Returns:
+        dict: file_id -> list of permission dictionaries.
+    """
+    fields = "permissions(id, role, type, emailAddress, domain, allowFileDiscovery, permissionDetails)"
+    requests = [(file_id, service.permissions().list(fileId=file_id, supportsAllDrives=True, fields=fields))
+                for file_id in file_ids]
+    permissions = {}
+    for file_id, (response, exception) in batch_execute(service, requests).items():
+        if exception:
+            logger.warning(f"Batched permissions call failed for {file_id}, retrying alone: {exception}")
+            permissions[file_id] = get_permission_details(service, file_id)
+        else:
+            permissions[file_id] = response.get('permissions', [])
+    return permissions
+
+class ServicePool:
+    """
+    Thread safe access to the Drive API for code that makes many requests at once.
+
+    A googleapiclient service sends every request over the one httplib2.Http it was built with, which is
+    not thread safe, so a service must never be shared between threads.  service() returns the calling
+    thread's own drive service, built the first time that thread asks for one.  Each is built on its own
+    AuthorizedHttp over an httplib2.Http that keeps its connection open between requests, and all of them
+    share one set of credentials, so the user signs in once however many threads there are.
+
+    submit(fn, *args) runs fn(service, *args) on one of max_workers worker threads and returns a Future,
+    and list_files(), get_metadata(), get_permissions() and friends do the same for the functions of this
+    module.  Every request still goes through rate_limiter, which is shared by all threads.
+
+    factory, a callable returning a new service, replaces the real services, e.g. with a FakeDrive:
+        pool = ServicePool(16, factory=lambda: drive)
+    """
+    def __init__(self, max_workers=8, factory=None, timeout=120):
+        self.max_workers = max_workers
+        self.factory = factory or self._build
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.credentials = None
+        self.executor = None
+        self.services = 0   # number of services built
+
+    def _build(self):
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = load_credentials()
+        http = AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=self.timeout))
+        return build('drive', 'v3', http=http, cache_discovery=False)
+
+    def service(self):
+        """The drive service of the calling thread."""
+        service = getattr(self.local, 'service', None)
+        if service is None:
+            service = self.local.service = self.factory()
+            with self.lock:
+                self.services += 1
+        return service
+
+    def _run(self, fn, args, kwargs):
+        return fn(self.service(), *args, **kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(service, *args, **kwargs) on a worker thread with that thread's service; returns a Future."""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='drive')
+        return self.executor.submit(self._run, fn, args, kwargs)
+
+    def map(self, fn, *iterables):
+        """Like Executor.map: fn(service, *args) for each set of args, results in order."""
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return (future.result() for future in futures)
+
+    def get_metadata(self, file_id, additional_fields=None, profile=None):
+        return self.submit(get_metadata, file_id, additional_fields, profile)
+
+    def list_files(self, folder_id, drive_id=None, additional_fields=None, profile='du-report'):
+        return self.submit(list_files, folder_id, drive_id, additional_fields, profile)
+
+    def list_drive_files(self, drive_id, additional_fields=None, profile='du-report'):
+        return self.submit(list_drive_files, drive_id, additional_fields, profile)
+
+    def get_permissions(self, file_id):
+        return self.submit(get_permissions, file_id)
+
+    def get_permission_details(self, file_id):
+        return self.submit(get_permission_details, file_id)
+
+    def get_permission_details_batch(self, file_ids):
+        return self.submit(get_permission_details_batch, file_ids)
+
+    def close(self, wait=True):
+        """Stop the worker threads; the pool can still be used afterwards and starts new ones."""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 class CPermission:
     def __init__(self, id, type, role, emailAddress=None, domain=None, allowFileDiscovery=None, permissionDetails=None, data=None):
         self.id = id
@@ -291,6 +806,17 @@ class CPermission:
         permissions = get_permission_details(service, file_id)
         return [cls.from_dict(permission) for permission in permissions]
 
+    def inherited_copy(self, parent_id):
+        """Return this permission as it appears on a child of the item that holds it: the same grant with
+        every permission detail marked inherited.  Details that were direct here are inherited from parent_id."""
+        details = [CPermissionDetail(inherited=True,
+                                     inheritedFrom=pd.inheritedFrom if pd.inherited else parent_id,
+                                     role=pd.role,
+                                     permissionType=pd.permissionType)
+                   for pd in self.permissionDetails]
+        return CPermission(self.id, self.type, self.role, self.emailAddress, self.domain,
+                           self.allowFileDiscovery, permissionDetails=details, data=self.data)
+
     def longform(self):
         details = "\n".join(str(detail) for detail in self.permissionDetails.longform())
         return (f"Permission ID: {self.id}\n"
@@ -415,7 +941,47 @@ class CPermissionDetail:
 
 
 # test code for this module when the module is directly invoked
+def benchmark_profiles(files=20000):
+    """
+    List a My Drive folder of `files` shared files on a FakeDrive with each of PROFILES, and print the
+    requests, the size of the json responses and the time taken to parse them, as googleapiclient does.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from FakeDrive import FakeDrive
+
+    drive = FakeDrive()
+    folder = drive.add_file('Bench', 'root', mimeType='application/vnd.google-apps.folder',
+                            grants=[{'id': 'p1', 'type': 'user', 'role': 'writer', 'emailAddress': 'team@example.org'}])
+    for i in range(files):
+        drive.add_file(f'file{i:06d}.pdf', folder, size=1000 + i, md5Checksum=f'{i:032x}',
+                       createdTime='2019-01-01T00:00:00.000Z', description='', starred=False,
+                       webViewLink=f'https://drive.google.com/file/d/{i}/view', shared=True,
+                       grants=[{'id': f'u{i % 50}', 'type': 'user', 'role': 'reader', 'emailAddress': f'user{i % 50}@example.org'}])
+    for profile in PROFILES:
+        file_fields = profile_fields(profile)
+        pages = []
+        page_token = None
+        while True:
+            result = drive.files().list(q=f"'{folder}' in parents and trashed = false", pageSize=page_size(file_fields),
+                                        fields=f"nextPageToken, files({file_fields})", pageToken=page_token).execute()
+            pages.append(json.dumps(result).encode('utf-8'))
+            page_token = result.get('nextPageToken')
+            if page_token is None:
+                break
+        start = time.perf_counter()
+        for page in pages:
+            json.loads(page)
+        parse_time = time.perf_counter() - start
+        size = sum(len(page) for page in pages)
+        print(f"{profile:>10}: {len(pages)} requests, {size / 1e6:.1f} MB, {size / files:.0f} bytes per file, "
+              f"parsed in {parse_time * 1000:.0f} ms ({parse_time / files * 1e6:.1f} us per file)")
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['--bench-profiles']:
+        # GDService.py --bench-profiles [files]
+        benchmark_profiles(*[int(arg) for arg in sys.argv[2:3]])
+        sys.exit(0)
+
     # Authenticate the user
     drive_service, _, _, _ = authenticate()
     # Get the permissions for a specific file
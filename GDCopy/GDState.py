@@ -0,0 +1,309 @@
+"""
+Indexed, durable store for gdcopy migration state, replacing gdcopy_state.json.
+
+gdcopy_state.json holds `src2dest`, the metadata of every source item keyed by its id with the id of its
+copy in 'dest_id', and `shortcuts_to_copy`, the [shortcut id, destination folder id] pairs still to be
+recreated.  Loading it means parsing the whole file, and it was only written when a copy finished, so a
+crash lost the whole run.  StateStore keeps the same data in SQLite:
+
+    src2dest  (src_id PRIMARY KEY, dest_id indexed, name, parent_id, data)  - data is the item as json
+    shortcuts (src_id PRIMARY KEY, dest_folder_id)
+
+so opening is instant, src -> dest and dest -> src are both index lookups, and every put() is committed as
+it happens.  The database runs in WAL mode with the file memory mapped, which keeps per write commits cheap.
+
+Src2Dest and Shortcuts are dict and list like views of the two tables, so code written against the json
+state keeps working.  This module has no local imports so that it can be imported both as GDState from
+the GDCopy folder and as GDCopy.GDState from DU-via-GD.
+"""
+import os
+import sys
+import json
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+class StateStore:
+    def __init__(self, path='gdcopy_state.db'):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA mmap_size=268435456")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS src2dest (src_id TEXT PRIMARY KEY, dest_id TEXT, name TEXT, parent_id TEXT, data TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS src2dest_dest_id ON src2dest (dest_id);
+            CREATE TABLE IF NOT EXISTS shortcuts (src_id TEXT PRIMARY KEY, dest_folder_id TEXT NOT NULL);
+        """)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(src2dest)")]
+        if 'name' not in columns:
+            # stores created before name and parent_id were kept in their own columns
+            self.conn.executescript("""
+                ALTER TABLE src2dest ADD COLUMN name TEXT;
+                ALTER TABLE src2dest ADD COLUMN parent_id TEXT;
+                UPDATE src2dest SET name = json_extract(data, '$.name'), parent_id = json_extract(data, '$.parents[0]');
+            """)
+        self.conn.commit()
+
+    @staticmethod
+    def _row(src_id, item):
+        parents = item.get('parents')
+        return (src_id, item.get('dest_id'), item.get('name'), parents[0] if parents else None, json.dumps(item))
+
+    # ---------------------------------------------------------------- src2dest
+    def get(self, src_id):
+        """The source item with id src_id, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM src2dest WHERE src_id = ?", (src_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find_dest(self, dest_id):
+        """The source item that was copied to dest_id, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM src2dest WHERE dest_id = ?", (dest_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, item):
+        """Store item, keyed by item['id'], and commit."""
+        self.put_many([item])
+
+    def put_many(self, items):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO src2dest (src_id, dest_id, name, parent_id, data) VALUES (?, ?, ?, ?, ?)",
+                                  (self._row(item['id'], item) for item in items))
+            self.conn.commit()
+
+    def delete(self, src_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM src2dest WHERE src_id = ?", (src_id,))
+            self.conn.commit()
+
+    def src_ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT src_id FROM src2dest")]
+
+    def items(self):
+        """Yield (src_id, item) for every source item."""
+        with self.lock:
+            rows = self.conn.execute("SELECT src_id, data FROM src2dest").fetchall()
+        for src_id, data in rows:
+            yield src_id, json.loads(data)
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM src2dest").fetchone()[0]
+
+    # ---------------------------------------------------------------- shortcuts
+    def add_shortcut(self, src_id, dest_folder_id):
+        """Queue shortcut src_id to be recreated in dest_folder_id, replacing any earlier entry for it."""
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO shortcuts (src_id, dest_folder_id) VALUES (?, ?)", (src_id, dest_folder_id))
+            self.conn.commit()
+
+    def remove_shortcut(self, src_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM shortcuts WHERE src_id = ?", (src_id,))
+            self.conn.commit()
+
+    def shortcuts(self):
+        """The [shortcut id, destination folder id] pairs, oldest first."""
+        with self.lock:
+            return [list(row) for row in self.conn.execute("SELECT src_id, dest_folder_id FROM shortcuts ORDER BY rowid")]
+
+    # ---------------------------------------------------------------- json state files
+    def import_json(self, path):
+        """Add the contents of a gdcopy_state.json file, its entries replacing any already in the store."""
+        return merge_state_files(self, [path])
+
+    def export_json(self, path):
+        """Write the store out in the gdcopy_state.json format."""
+        state = {'src2dest': dict(self.items()), 'shortcuts_to_copy': self.shortcuts()}
+        with open(path, 'w') as f:
+            json.dump(state, f)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def original_paths(store):
+    """
+    Return a dict mapping every dest_id in the store to the path of its source item, following the first
+    parent of each item until one is not in the store.  Built in a single pass over the table: each
+    ancestor's path is computed once and reused as the prefix of everything beneath it, so the cost is
+    proportional to the number of items rather than to the sum of their depths.
+    """
+    with store.lock:
+        rows = store.conn.execute("SELECT src_id, dest_id, name, parent_id FROM src2dest").fetchall()
+    names = {}
+    parents = {}
+    for src_id, dest_id, name, parent in rows:
+        names[src_id] = name
+        parents[src_id] = parent
+
+    paths = {}  # src_id -> path, memoized
+    for src_id in names:
+        # climb until reaching an item whose path is known or that is not in the store
+        chain = []
+        on_chain = set()
+        node = src_id
+        while node in names and node not in paths and node not in on_chain:
+            chain.append(node)
+            on_chain.add(node)
+            node = parents[node]
+        # a parent chain that loops back on itself is treated as starting at the repeated item
+        prefix = paths.get(node)
+        for node in reversed(chain):
+            prefix = names[node] if prefix is None else prefix + '/' + names[node]
+            paths[node] = prefix
+
+    return {dest_id: paths[src_id] for src_id, dest_id, name, parent in rows if dest_id}
+
+def open_state(path='gdcopy_state.db', json_files=('gdcopy_state_old.json', 'gdcopy_state.json')):
+    """
+    Open the state store at path.  When it does not exist yet, it is created from whichever of json_files
+    exist, imported in order so that later files win.
+    """
+    exists = os.path.exists(path)
+    store = StateStore(path)
+    if not exists:
+        merge_state_files(store, [json_file for json_file in json_files if os.path.exists(json_file)], by_time=False)
+    return store
+
+class MergeStats:
+    """What merge_state_files() did.  conflicts holds (src_id, earlier dest_id, later dest_id, file) for each conflict."""
+    def __init__(self):
+        self.files = 0
+        self.added = 0
+        self.unchanged = 0
+        self.updated = 0
+        self.kept = 0
+        self.conflicts = []
+        self.shortcuts = 0
+
+    def __str__(self):
+        return (f"Merged {self.files} state files: {self.added} added, {self.updated} updated, {self.unchanged} unchanged, "
+                f"{self.kept} kept their destination over a later entry without one, {len(self.conflicts)} copied to a different destination by a later migration, {self.shortcuts} shortcuts")
+
+def merge_state_files(store, paths, by_time=True):
+    """
+    Merge gdcopy state json files into store, one file at a time and oldest first by modification time (or
+    in the order given when by_time is False).  An entry in a later file replaces the entry for the same
+    source id from an earlier one, as does a queued shortcut.  When both name a destination and they differ,
+    typically because a migration was reverted and run again, the later one wins and the pair is recorded
+    as a conflict in the returned MergeStats.  A later entry without a destination, as left by an
+    interrupted or DRY_RUN migration, keeps the destination already known, since losing it would have the
+    next copy duplicate the item.
+
+    Only one file is parsed at a time, and what is carried between files is the destination id of each
+    unique source id, so time is linear in the total number of entries and memory is bounded by the
+    largest single file, which load_state() always had to hold anyway.
+    """
+    if by_time:
+        paths = sorted(paths, key=os.path.getmtime)
+    stats = MergeStats()
+    with store.lock:
+        dest_ids = dict(store.conn.execute("SELECT src_id, dest_id FROM src2dest"))
+    for path in paths:
+        with open(path, 'r') as f:
+            state = json.load(f)
+        rows = []
+        for src_id, item in state.get('src2dest', {}).items():
+            dest_id = item.get('dest_id')
+            if src_id not in dest_ids:
+                stats.added += 1
+            elif dest_ids[src_id] and not dest_id:
+                stats.kept += 1
+                dest_id = dest_ids[src_id]
+                item = dict(item, dest_id=dest_id)
+            elif dest_ids[src_id] == dest_id:
+                stats.unchanged += 1
+            else:
+                stats.updated += 1
+                if dest_ids[src_id] and dest_id:
+                    stats.conflicts.append((src_id, dest_ids[src_id], dest_id, path))
+            dest_ids[src_id] = dest_id
+            rows.append(StateStore._row(src_id, item))
+        shortcuts = [tuple(shortcut) for shortcut in state.get('shortcuts_to_copy', [])]
+        del state
+        with store.lock:
+            store.conn.executemany("INSERT OR REPLACE INTO src2dest (src_id, dest_id, name, parent_id, data) VALUES (?, ?, ?, ?, ?)", rows)
+            store.conn.executemany("INSERT OR REPLACE INTO shortcuts (src_id, dest_folder_id) VALUES (?, ?)", shortcuts)
+            store.conn.commit()
+        stats.files += 1
+        stats.shortcuts += len(shortcuts)
+    return stats
+
+class Src2Dest(MutableMapping):
+    """
+    dict like view of the src2dest table.  Items that are read are kept, so that changes made to them in
+    place are seen for the rest of the run; store.put() them, or call flush(), to make those changes durable.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.cache = {}
+
+    def __getitem__(self, src_id):
+        item = self.cache.get(src_id)
+        if item is None:
+            item = self.store.get(src_id)
+            if item is None:
+                raise KeyError(src_id)
+            self.cache[src_id] = item
+        return item
+
+    def __setitem__(self, src_id, item):
+        self.cache[src_id] = item
+        self.store.put(item)
+
+    def __delitem__(self, src_id):
+        self.cache.pop(src_id, None)
+        self.store.delete(src_id)
+
+    def __contains__(self, src_id):
+        return src_id in self.cache or self.store.get(src_id) is not None
+
+    def __iter__(self):
+        return iter(self.store.src_ids())
+
+    def __len__(self):
+        return self.store.count()
+
+    def flush(self):
+        """Write back every item read or stored during this run."""
+        self.store.put_many(list(self.cache.values()))
+
+class Shortcuts:
+    """list like view of the shortcuts table, supporting append(), iteration and len()."""
+    def __init__(self, store):
+        self.store = store
+
+    def append(self, shortcut):
+        self.store.add_shortcut(*shortcut)
+
+    def remove(self, shortcut):
+        self.store.remove_shortcut(shortcut[0])
+
+    def __iter__(self):
+        return iter(self.store.shortcuts())
+
+    def __len__(self):
+        return len(self.store.shortcuts())
+
+if __name__ == '__main__':
+    # GDState.py merge <state.db> <state.json>...   merge json state files, oldest first, into state.db
+    # GDState.py export <state.db> <state.json>     write state.db out in the json format
+    if sys.argv[1:2] == ['merge'] and len(sys.argv) > 3:
+        store = StateStore(sys.argv[2])
+        stats = merge_state_files(store, sys.argv[3:])
+        print(stats)
+        for src_id, earlier, later, path in stats.conflicts:
+            print(f"  {src_id}: {earlier} -> {later} ({path})")
+        store.close()
+    elif sys.argv[1:2] == ['export'] and len(sys.argv) == 4:
+        store = StateStore(sys.argv[2])
+        store.export_json(sys.argv[3])
+        store.close()
+    else:
+        print(__doc__)
+        print("usage: GDState.py merge <state.db> <state.json>...\n       GDState.py export <state.db> <state.json>")
@@ -19,7 +19,7 @@ from PyPDF2 import PdfMerger
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from datetime import datetime
-from GDCopy.GDService import authenticate, list_files, retry_request
+from GDCopy.GDService import authenticate, iter_files, retry_request
 from googleapiclient.http import MediaIoBaseDownload
 import win32com.client
 
@@ -220,8 +220,8 @@ def process_folder(drive_service, folder_id, pattern, output_dir, file_type='txt
     all_files = []
 
     def collect_files(folder_id, path=""):
-        files = list_files(drive_service, folder_id, additional_fields="size, modifiedTime")
-        for f in files:
+        # iter_files hands over each page as it arrives, so the first files are handled without waiting for the last page
+        for f in iter_files(drive_service, folder_id, additional_fields="size", profile='minimal'):
             if f['mimeType'] == 'application/vnd.google-apps.folder':
                 collect_files(f['id'], path + f['name'] + "/")
             else:
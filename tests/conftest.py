@@ -0,0 +1,72 @@
+"""
+Shared fixtures: DU-via-GD loaded as a module, and a FakeDrive tree to walk.
+
+DU-via-GD.py cannot be imported by name, so it is loaded from its path.  Every Drive service it asks for
+is the FakeDrive, through a ServicePool whose factory returns it.
+"""
+import os
+import sys
+import random
+import importlib.util
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from GDCopy.FakeDrive import FakeDrive
+
+
+def load_du():
+    spec = importlib.util.spec_from_file_location('du', os.path.join(ROOT, 'DU-via-GD.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['du'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def du():
+    return load_du()
+
+
+def build_tree(depth=3, fanout=4, files=5, seed=1):
+    """A shared drive with a folder 'Top' fanout wide and depth deep, files files in each folder and some direct grants."""
+    r = random.Random(seed)
+    drive = FakeDrive()
+    drive_id = drive.add_drive('Drive', grants=[{'id': 'p1', 'role': 'organizer', 'type': 'user', 'emailAddress': 'a@example.org'}])
+    top = drive.add_folder('Top', drive_id)
+
+    def fill(parent, level):
+        for i in range(files):
+            grants = [{'id': f'g{r.randint(1, 3)}', 'role': 'reader', 'type': 'user', 'emailAddress': 'r@example.org'}] if r.random() < 0.2 else None
+            drive.add_file(f'file{i}.txt', parent, size=r.randint(1, 1000),
+                           modifiedTime=f'2021-0{r.randint(1, 9)}-1{r.randint(0, 9)}T10:00:00.000Z', grants=grants)
+        if level < depth:
+            for j in range(fanout):
+                grants = [{'id': 'g9', 'role': 'writer', 'type': 'group', 'emailAddress': 'group@example.org'}] if r.random() < 0.2 else None
+                fill(drive.add_folder(f'sub{j}', parent, grants=grants), level + 1)
+
+    fill(top, 0)
+    return drive, drive_id, top
+
+
+class ListCollector:
+    """Collector stand-in keeping what the walker reports for each entry, in order."""
+    def __init__(self):
+        self.rows = []
+
+    def add(self, entry, mostrecent=None, path=None, error=None, filecount=None):
+        self.rows.append((entry.path if entry else None, entry.size if entry else None, entry.localsize if entry else None,
+                          mostrecent.path if mostrecent else None, filecount, error, path,
+                          tuple(getattr(entry, 'permissions', ()) or ()), tuple(getattr(entry, 'direct_permissions', ()) or ())))
+
+
+@pytest.fixture
+def fake_drive(du, tmp_path, monkeypatch):
+    """A FakeDrive tree that du walks, run from an empty directory so that no state or cache files are picked up."""
+    monkeypatch.chdir(tmp_path)
+    drive, drive_id, top = build_tree()
+    monkeypatch.setattr(du, 'service_pool', du.GDService.ServicePool(factory=lambda: drive))
+    monkeypatch.setattr(du, 'original_paths', {})
+    return drive, top
@@ -0,0 +1,78 @@
+"""FileSystemWalker against a FakeDrive: the metadata cache, the concurrent walk and checkpoint resume."""
+import csv
+
+import pytest
+
+from GDCopy.FakeDrive import FakeDriveError
+from conftest import ListCollector
+
+
+def walk(du, top, **kwargs):
+    collector = ListCollector()
+    du.FileSystemWalker(top, collector, **kwargs).walk()
+    return collector.rows
+
+
+def test_second_walk_with_cache_makes_almost_no_list_calls(du, fake_drive, tmp_path):
+    drive, top = fake_drive
+    cache_file = str(tmp_path / 'cache.db')
+    first = walk(du, top, cache_file=cache_file)
+    lists = drive.calls['files.list']
+    assert lists > 50
+
+    second = walk(du, top, cache_file=cache_file)
+    assert second == first
+    assert drive.calls['files.list'] - lists <= 1
+
+    # a change is picked up without listing everything again
+    changed = next(item for item in drive.items.values() if item['name'] == 'file1.txt')
+    drive.update_item(changed['id'], size='999999')
+    lists = drive.calls['files.list']
+    third = walk(du, top, cache_file=cache_file)
+    assert drive.calls['files.list'] - lists <= 2
+    assert sorted(third) == sorted(walk(du, top))
+    assert third != first
+
+
+@pytest.mark.parametrize('max_inflight', [2, 8])
+def test_concurrent_walk_matches_serial(du, fake_drive, max_inflight):
+    drive, top = fake_drive
+    serial = walk(du, top)
+    assert walk(du, top, max_inflight=max_inflight) == serial
+
+
+def rollups(path):
+    with open(path, newline='') as f:
+        return {row['path']: (row['size'], row['localsize'], row['filecount'], row['mr_path'], row['mr_mtime'], row['type'])
+                for row in csv.DictReader(f)}
+
+
+@pytest.mark.parametrize('max_inflight', [None, 4])
+def test_walk_killed_part_way_resumes_to_the_same_rollups(du, fake_drive, tmp_path, max_inflight):
+    drive, top = fake_drive
+    clean = str(tmp_path / 'clean.csv')
+    collector = du.Collector(clean, [top], [])
+    du.FileSystemWalker(top, collector, max_inflight=max_inflight).walk()
+    collector.save()
+
+    resumed = str(tmp_path / 'resumed.csv')
+    checkpoint = str(tmp_path / 'resumed.checkpoint')
+    crashes = 0
+    while True:
+        drive.fail_after = drive.total_calls() + 40
+        collector = du.Collector(resumed, [top], [])
+        walker = du.FileSystemWalker(top, collector, max_inflight=max_inflight, checkpoint_file=checkpoint)
+        try:
+            walker.walk()
+        except FakeDriveError:
+            crashes += 1
+            assert crashes < 20
+            continue
+        drive.fail_after = None
+        collector.save()
+        walker.remove_checkpoint()
+        break
+
+    assert crashes >= 2
+    assert rollups(resumed) == rollups(clean)
+    assert not (tmp_path / 'resumed.checkpoint').exists()